@@ -0,0 +1,57 @@
+# Time the approximate median background against the exact median filter on a
+# synthetic CSPAD stack and measure how far it is from the exact median.
+import time
+import argparse
+import numpy as np
+from scipy import ndimage
+from psocake.medianBackground import MedianBackground
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=5, help="number of events to time")
+parser.add_argument('--medianRank', type=int, default=5, help="median window is 2*rank+1 pixels wide")
+parser.add_argument('--medianThreads', type=int, default=4, help="number of threads")
+parser.add_argument('--panels', type=int, default=32, help="number of panels in the synthetic stack")
+args = parser.parse_args()
+
+def syntheticStack(seed):
+    """Slowly varying background with noise and a few Bragg peaks"""
+    rng = np.random.RandomState(seed)
+    rows, cols = np.indices((185, 388))
+    stack = np.zeros((args.panels, 185, 388), dtype=np.float32)
+    for p in range(args.panels):
+        stack[p] = 50 + 20 * np.sin(rows / 40. + p) * np.cos(cols / 60.)
+    stack += rng.normal(0, 5, stack.shape)
+    for i in range(200):
+        p, r, c = rng.randint(args.panels), rng.randint(2, 183), rng.randint(2, 386)
+        stack[p, r-1:r+2, c-1:c+2] += 1000
+    return stack
+
+width = 2 * args.medianRank + 1
+stacks = [syntheticStack(seed) for seed in range(args.noe)]
+
+tic = time.time()
+exact = [np.array([ndimage.median_filter(p, size=width) for p in s]) for s in stacks]
+print("%10s: %8.2f ms per event" % ("exact", (time.time() - tic) / args.noe * 1e3))
+
+for numThreads in sorted(set([1, args.medianThreads])):
+    mb = MedianBackground(args.medianRank, numThreads)
+    tic = time.time()
+    for s in stacks:
+        mb.getBackground(s)
+    print("%10s: %8.2f ms per event with %d threads" % ("separable", (time.time() - tic) / args.noe * 1e3, numThreads))
+
+# Error against the exact median and rank of the approximation inside its window
+approx = mb.getBackground(stacks[0])
+diff = np.abs(approx - exact[0])
+print("difference to the exact median: mean %.3f, 99%% %.3f, max %.3f (noise sigma 5)" % \
+      (diff.mean(), np.percentile(diff, 99), diff.max()))
+rng = np.random.RandomState(0)
+padded = np.pad(stacks[0], ((0, 0), (args.medianRank,) * 2, (args.medianRank,) * 2), mode='symmetric')
+ranks = []
+for i in range(2000):
+    p, r, c = rng.randint(args.panels), rng.randint(185), rng.randint(388)
+    window = padded[p, r:r+width, c:c+width]
+    ranks.append((window < approx[p, r, c]).sum() / float(window.size))
+bound = 1 - (args.medianRank + 1) ** 2 / float(width ** 2)
+print("fraction of the window pixels below the approximation: %.2f to %.2f, bound %.2f to %.2f" % \
+      (min(ranks), max(ranks), 1 - bound, bound))
@@ -0,0 +1,78 @@
+# Time peak finding on a synthetic CSPAD stack with the panels split over 1, 2, 4, ...
+# threads and check that the merged peak lists match the single call.
+# Uses PyAlgos when psana is available, a scipy stand-in otherwise.
+import time
+import argparse
+import numpy as np
+from psocake.panelParallel import PanelGroupFinder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=10, help="number of events to time")
+parser.add_argument('--maxThreads', type=int, default=8, help="largest number of threads")
+args = parser.parse_args()
+
+class LocalMaxFinder(object):
+    """PyAlgos stand-in: pixels above thr_high that are the maximum of their (2*rank+1)^2 window"""
+    def __init__(self, mask):
+        self.mask = mask
+
+    def set_peak_selection_pars(self, **kwargs):
+        pass
+
+    def set_mask(self, mask):
+        self.mask = mask
+
+    def peak_finder_v4r2(self, calib, thr_low=0, thr_high=0, rank=3, r0=0, dr=0):
+        from scipy import ndimage
+        nda = calib * self.mask
+        local = ndimage.maximum_filter(nda, size=(1, 2 * rank + 1, 2 * rank + 1))
+        seg, row, col = np.nonzero((nda == local) & (nda > thr_high))
+        peaks = np.zeros((seg.size, 17))
+        peaks[:, 0], peaks[:, 1], peaks[:, 2] = seg, row, col
+        peaks[:, 4] = nda[seg, row, col]
+        return peaks
+
+try:
+    from ImgAlgos.PyAlgos import PyAlgos
+    makeAlg = lambda mask: PyAlgos(mask=mask, pbits=0)
+    finderName = "PyAlgos"
+except ImportError:
+    makeAlg = LocalMaxFinder
+    finderName = "scipy stand-in"
+
+def syntheticStack(seed):
+    rng = np.random.RandomState(seed)
+    stack = rng.normal(10, 3, (32, 185, 388)).astype(np.float32)
+    for i in range(300):
+        p, r, c = rng.randint(32), rng.randint(3, 182), rng.randint(3, 385)
+        stack[p, r-1:r+2, c-1:c+2] += rng.uniform(200, 2000)
+    return stack
+
+mask = np.ones((32, 185, 388), dtype=np.uint16)
+stacks = [syntheticStack(seed) for seed in range(args.noe)]
+params = dict(thr_low=30, thr_high=150, rank=3, r0=4, dr=2)
+
+print("peak finder: %s" % finderName)
+reference = makeAlg(mask)
+reference.set_peak_selection_pars(npix_min=2, npix_max=50, amax_thr=10, atot_thr=20, son_min=5)
+reference.peak_finder_v4r2(stacks[0], **params) # warm up
+tic = time.time()
+expected = [reference.peak_finder_v4r2(s, **params) for s in stacks]
+single = (time.time() - tic) / args.noe
+print("%8s: %8.2f ms per event" % ("single", single * 1e3))
+
+def sortedPeaks(peaks):
+    peaks = np.asarray(peaks)
+    return peaks[np.lexsort(peaks[:, 2::-1].T)] if len(peaks) else peaks
+
+numThreads = 1
+while numThreads <= args.maxThreads:
+    finder = PanelGroupFinder(makeAlg, mask, numThreads)
+    finder.set_peak_selection_pars(npix_min=2, npix_max=50, amax_thr=10, atot_thr=20, son_min=5)
+    tic = time.time()
+    found = [finder.peak_finder_v4r2(s, **params) for s in stacks]
+    perEvent = (time.time() - tic) / args.noe
+    same = sum([np.array_equal(sortedPeaks(a), sortedPeaks(b)) for a, b in zip(expected, found)])
+    print("%8d: %8.2f ms per event, speedup %.2f, %d of %d peak lists identical" % \
+          (numThreads, perEvent * 1e3, single / perEvent, same, args.noe))
+    numThreads *= 2
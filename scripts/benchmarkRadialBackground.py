@@ -0,0 +1,84 @@
+# Time the radial background subtraction of findPeaks on a synthetic CSPAD frame
+# and check it against the per event RadialBkgd path it replaced. Without psana
+# the reference is a plain numpy transcription of that path.
+import time
+import argparse
+import numpy as np
+from psocake.fastBackground import RadialBackground, polarizationFactor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=20, help="number of events to time")
+parser.add_argument('--distance', type=float, default=0.1, help="detector distance in m")
+parser.add_argument('--pixelSize', type=float, default=110., help="pixel size in um")
+args = parser.parse_args()
+
+def syntheticGeometry(gap=6):
+    """Pixel coordinates in um and edge mask of (32,185,388) panels on a grid around the beam"""
+    shape = (32, 185, 388)
+    rows, cols = np.indices(shape[1:])
+    xarr = np.zeros(shape)
+    yarr = np.zeros(shape)
+    for quad in range(4):
+        for seg in range(8):
+            p = quad * 8 + seg
+            xarr[p] = (seg * (shape[1] + gap) + rows - 4 * (shape[1] + gap)) * args.pixelSize
+            yarr[p] = (quad * (shape[2] + gap) + cols - 2 * (shape[2] + gap)) * args.pixelSize
+    mask = np.ones(shape, dtype=np.uint16)
+    mask[:, [0, -1], :] = 0
+    mask[:, :, [0, -1]] = 0
+    return xarr, yarr, mask
+
+def syntheticFrame(xarr, yarr, seed):
+    """Water ring and noise"""
+    rng = np.random.RandomState(seed)
+    rad = np.hypot(xarr, yarr)
+    ring = 100 * np.exp(-((rad - 30000.) / 3000.) ** 2)
+    return (ring + rng.normal(10, 3, xarr.shape)).astype(np.float32)
+
+class ReferenceBackground(object):
+    """RadialBkgd(..., nradbins=100, phiedges=(0,360), nphibins=1) with polarization_factor"""
+    def __init__(self, xarr, yarr, mask, distance):
+        try:
+            from pyimgalgos.RadialBkgd import RadialBkgd, polarization_factor
+            self.rb = RadialBkgd(xarr, yarr, mask=mask, radedges=None, nradbins=100, phiedges=(0, 360), nphibins=1)
+            self.pf = polarization_factor(self.rb.pixel_rad(), self.rb.pixel_phi(), distance)
+            self.name = "RadialBkgd"
+        except ImportError:
+            self.rb = None
+            self.xarr, self.yarr, self.mask = xarr, yarr, mask
+            self.pf = polarizationFactor(np.hypot(xarr, yarr), np.arctan2(yarr, xarr), distance).ravel()
+            self.name = "numpy"
+
+    def subtract(self, calib):
+        if self.rb is not None:
+            self.pf.shape = calib.shape
+            return self.rb.subtract_bkgd(calib * self.pf)
+        # everything but the polarization factor was redone per event
+        rad = np.hypot(self.xarr, self.yarr).ravel()
+        ibin = np.clip(((rad - rad.min()) / (rad.max() - rad.min()) * 100).astype(int), 0, 99)
+        nda = calib.ravel() * self.pf
+        mask = self.mask.ravel()
+        num = np.bincount(ibin, weights=nda * mask, minlength=100)
+        den = np.bincount(ibin, weights=mask, minlength=100)
+        avrg = np.where(den > 0, num / np.maximum(den, 1), 0)
+        return nda - avrg[ibin]
+
+xarr, yarr, mask = syntheticGeometry()
+frames = [syntheticFrame(xarr, yarr, seed) for seed in range(args.noe)]
+
+tic = time.time()
+reference = ReferenceBackground(xarr, yarr, mask, args.distance * 1e6)
+print("%12s: setup %8.2f ms" % ("reference", (time.time() - tic) * 1e3))
+tic = time.time()
+rb = RadialBackground(xarr, yarr, mask=mask, nradbins=100, distance=args.distance * 1e6)
+print("%12s: setup %8.2f ms" % ("tables", (time.time() - tic) * 1e3))
+
+tic = time.time()
+expected = [reference.subtract(f) for f in frames]
+print("%12s: %8.2f ms per event (%s)" % ("reference", (time.time() - tic) / args.noe * 1e3, reference.name))
+tic = time.time()
+for f in frames:
+    rb.subtract(f)
+perEvent = (time.time() - tic) / args.noe
+worst = max([np.abs(rb.subtract(f).ravel() - np.asarray(e).ravel()).max() for f, e in zip(frames, expected)])
+print("%12s: %8.2f ms per event, largest difference %g" % ("tables", perEvent * 1e3, worst))
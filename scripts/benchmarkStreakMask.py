@@ -0,0 +1,105 @@
+# Time the streak mask on synthetic CSPAD frames and check it against the
+# previous implementation, which assembled the whole image for every event.
+# With --stable the streak stays in place and the cadence mode reuses its mask.
+import time
+import argparse
+import numpy as np
+from scipy import signal as sg
+from skimage.measure import label
+from psocake.myskbeam import StreakMask
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=20, help="number of events to time")
+parser.add_argument('--width', type=int, default=300, help="streak mask width")
+parser.add_argument('--sigma', type=float, default=1., help="streak mask sigma above background")
+parser.add_argument('--tolerance', type=float, default=0.05, help="signature drift that triggers a recomputation")
+parser.add_argument('--maxAge', type=int, default=100, help="maximum number of events a mask is reused for")
+parser.add_argument('--stable', action='store_true', help="keep the streak in place, only the pulse intensity changes")
+args = parser.parse_args()
+
+class SyntheticCspad(object):
+    """Detector stand-in with (32,185,388) panels laid out on a grid with gaps"""
+    def __init__(self, gap=6):
+        self.shape = (32, 185, 388)
+        rows, cols = np.indices(self.shape[1:])
+        self.iX = np.zeros(self.shape, dtype=np.int64)
+        self.iY = np.zeros(self.shape, dtype=np.int64)
+        for quad in range(4):
+            for seg in range(8):
+                p = quad * 8 + seg
+                self.iX[p] = seg * (self.shape[1] + gap) + rows
+                self.iY[p] = quad * (self.shape[2] + gap) + cols
+        self.imgShape = (self.iX.max() + 1, self.iY.max() + 1)
+
+    def calib(self, evt):
+        return evt
+
+    def image(self, evt, nda=None):
+        if nda is None: nda = self.calib(evt)
+        img = np.zeros(self.imgShape)
+        img[self.iX, self.iY] = nda
+        return img
+
+    def point_indexes(self, evt):
+        return (self.imgShape[0] // 2, self.imgShape[1] // 2)
+
+def syntheticFrame(det, seed):
+    """Noisy background with a bright streak through the beam centre and a few Bragg peaks"""
+    rng = np.random.RandomState(seed)
+    img = rng.normal(10, 3, det.imgShape)
+    cx, cy = det.point_indexes(None)
+    angle = np.pi / 3 if args.stable else rng.uniform(0, np.pi)
+    for t in np.arange(-200, 200, 0.5):
+        x, y = int(cx + t * np.cos(angle)), int(cy + t * np.sin(angle))
+        img[x-1:x+2, y-1:y+2] += 200
+    for i in range(50):
+        x, y = rng.randint(0, det.imgShape[0] - 3), rng.randint(0, det.imgShape[1] - 3)
+        img[x:x+3, y:y+3] += 500
+    return img[det.iX, det.iY] * rng.uniform(0.5, 1.5)
+
+def referenceStreakMask(sm, evt, calib):
+    """getStreakMaskCalib as it was before the index table engine"""
+    img = sm.det.image(evt, calib)
+    imgCrop = img[sm.ix-sm.halfWidth:sm.ix+sm.halfWidth,sm.iy-sm.halfWidth:sm.iy+sm.halfWidth]
+    imgBlur=sg.convolve(imgCrop,np.ones((2,2)),mode='same')
+    mean = imgBlur[imgBlur>0].mean()
+    std = imgBlur[imgBlur>0].std()
+    mask = imgBlur > mean+sm.sigma*std
+    mask = mask.astype(int)
+    signalOnEdge = mask * sm.imgEdges
+    mySigInd = np.where(signalOnEdge==1)
+    mask[sm.myInd[0].ravel(),sm.myInd[1].ravel()] = 1
+    myLabel = label(mask, connectivity=1, background=0)
+    myMask = np.ones_like(mask)
+    myParts = np.unique(myLabel[sm.myInd])
+    for i in myParts:
+        myMask[np.where(myLabel == i)] = 0
+    myMask[sm.myInd]=1
+    myMask[mySigInd]=0
+    wholeMask = np.ones_like(sm.assem)
+    wholeMask[sm.ix-sm.halfWidth:sm.ix+sm.halfWidth,sm.iy-sm.halfWidth:sm.iy+sm.halfWidth] = myMask
+    pixInd = sm.assem[np.where(wholeMask==0)]
+    pixInd = pixInd[np.nonzero(pixInd)]-1
+    calibMask=np.ones((sm.calibSize,))
+    calibMask[pixInd.astype(int)] = 0
+    return calibMask.reshape(sm.calibShape)
+
+det = SyntheticCspad()
+frames = [syntheticFrame(det, seed) for seed in range(args.noe)]
+sm = StreakMask(det, frames[0], width=args.width, sigma=args.sigma)
+cadence = StreakMask(det, frames[0], width=args.width, sigma=args.sigma, tolerance=args.tolerance, maxAge=args.maxAge)
+
+for name, func in [("reference", lambda f: referenceStreakMask(sm, f, f)),
+                   ("index table", lambda f: sm.getStreakMaskCalib(f, f)),
+                   ("cadence", lambda f: cadence.getStreakMaskCalib(f, f))]:
+    tic = time.time()
+    masks = [func(f) for f in frames]
+    perEvent = (time.time() - tic) / args.noe
+    print("%12s: %8.2f ms per event, %d masked pixels in the first event" % \
+          (name, perEvent * 1e3, (masks[0] == 0).sum()))
+    if name == "reference":
+        reference = masks
+    else:
+        same = sum([np.array_equal(a, b) for a, b in zip(reference, masks)])
+        print("%12s  %d of %d masks identical to the reference" % ("", same, args.noe))
+print("cadence recomputed the mask for %d of %d events" % (cadence.numComputed, args.noe))
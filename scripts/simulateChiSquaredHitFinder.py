@@ -0,0 +1,57 @@
+# Run the running background of the chi-squared hit finder on synthetic frames
+# with injected hits. Checks the incremental mean and variance against numpy and
+# reports how many of the injected hits are found.
+import argparse
+import numpy as np
+from psocake.HitFinder_chiSquared import RunningBackground
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=600, help="number of events")
+parser.add_argument('--bufferLength', type=int, default=60, help="frames in the running background")
+parser.add_argument('--pruneInterval', type=int, default=100, help="frames between recomputations of the sums")
+parser.add_argument('--hitRate', type=float, default=0.05, help="fraction of frames with a hit")
+parser.add_argument('--nSigma', type=float, default=5., help="standard deviations of a lit pixel")
+parser.add_argument('--chiSquaredThreshold', type=float, default=1.5, help="chi-squared per pixel of a hit")
+args = parser.parse_args()
+
+shape = (4, 185, 388)
+numPixels = np.prod(shape)
+rng = np.random.RandomState(0)
+rows, cols = np.indices(shape[1:])
+# background drifting slowly in intensity, as the beam does
+base = np.tile(20 + 10 * np.cos(rows / 30.) * np.cos(cols / 50.), (shape[0], 1, 1)).ravel()
+
+def frame(i, isHit):
+    img = base * (1 + 0.2 * np.sin(i / 2000.)) + rng.normal(0, 3, numPixels)
+    if isHit: # diffraction speckles on a quarter of the detector
+        speckles = rng.randint(0, numPixels // 4, 300)
+        img[speckles] += rng.uniform(30, 100, speckles.size)
+    return img.astype(np.float32)
+
+bg = RunningBackground(numPixels, args.bufferLength, args.pruneInterval)
+for i in range(args.bufferLength):
+    bg.push(frame(-args.bufferLength + i, False))
+
+chiSquared = {True: [], False: []}
+found = falseAlarms = injected = 0
+for i in range(args.noe):
+    isHit = rng.uniform() < args.hitRate
+    values = frame(i, isHit)
+    score, lit = bg.score(values, args.nSigma)
+    chiSquared[isHit].append(score)
+    scoredHit = score > args.chiSquaredThreshold
+    injected += isHit
+    found += isHit and scoredHit
+    falseAlarms += scoredHit and not isHit
+    if not scoredHit:
+        bg.push(values)
+
+# incremental statistics against the frames in the buffer
+frames = bg.buffer[:bg.count].astype(np.float64)
+bg.update()
+print("largest difference to numpy: mean %.2g, variance %.2g" % \
+      (np.abs(bg.mean - frames.mean(axis=0)).max(),
+       np.abs(bg.variance - np.maximum(frames.var(axis=0), bg.minVariance)).max()))
+print("chi-squared per pixel of misses %.3f to %.3f, of hits %.3f to %.3f" % \
+      (min(chiSquared[False]), max(chiSquared[False]), min(chiSquared[True] or [0]), max(chiSquared[True] or [0])))
+print("%d of %d injected hits found, %d false alarms in %d events" % (found, injected, falseAlarms, args.noe))
@@ -0,0 +1,54 @@
+# Compare static round-robin and on-demand batched event distribution
+# on a synthetic run with deliberately slow events
+import heapq
+import argparse
+import numpy as np
+from psocake.eventDispenser import EventDispenser
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--noe', type=int, default=20000, help="number of synthetic events")
+parser.add_argument('-w', '--workers', type=int, default=64, help="number of worker ranks")
+parser.add_argument('--cost', type=float, default=0.05, help="typical cost of an event (s)")
+parser.add_argument('--slowFraction', type=float, default=0.01, help="fraction of slow events")
+parser.add_argument('--slowCost', type=float, default=2.0, help="cost of a slow event (s)")
+parser.add_argument('--latency', type=float, default=0.001, help="round trip time of a work request (s)")
+parser.add_argument('--batchTime', type=float, default=1.0, help="target time per batch (s)")
+parser.add_argument('--maxBatchSize', type=int, default=100, help="maximum batch size")
+args = parser.parse_args()
+
+def syntheticCosts():
+    np.random.seed(2017)
+    costs = np.random.exponential(args.cost, args.noe)
+    slow = np.random.rand(args.noe) < args.slowFraction
+    costs[slow] = args.slowCost
+    # a dense multi-hit stretch in the middle of the run
+    costs[args.noe//2:args.noe//2+args.noe//50] *= 5
+    return costs
+
+def runStatic(costs):
+    finish = np.zeros(args.workers)
+    for w in range(args.workers):
+        finish[w] = costs[w::args.workers].sum()
+    return finish
+
+def runDynamic(costs):
+    dispenser = EventDispenser(len(costs), args.workers, targetTime=args.batchTime, maxBatch=args.maxBatchSize)
+    finish = np.zeros(args.workers)
+    queue = [(0., w, 0, 0.) for w in range(args.workers)] # (free at, worker, last batch size, last batch time)
+    heapq.heapify(queue)
+    while queue:
+        now, w, batchSize, batchTime = heapq.heappop(queue)
+        start, stop = dispenser.nextBatch(batchSize, batchTime)
+        now += args.latency
+        if stop <= start:
+            finish[w] = now
+            continue
+        batchTime = costs[start:stop].sum()
+        heapq.heappush(queue, (now + batchTime, w, stop - start, batchTime))
+    return finish
+
+costs = syntheticCosts()
+for name, finish in [("static", runStatic(costs)), ("dynamic", runDynamic(costs))]:
+    makespan = finish.max()
+    print("%8s: makespan %8.2f s, throughput %8.1f Hz, tail (last - first idle rank) %8.2f s" % \
+          (name, makespan, len(costs) / makespan, makespan - finish.min()))
@@ -10,11 +10,52 @@ elif 'PAL' in os.environ['PSOCAKE_FACILITY']:
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
+class LitPixelCounter(object):
+    """Counts the pixels above several thresholds in several regions of interest.
+
+       The valid pixel mask and the flat indices of the valid pixels of every ROI
+       are computed once. Per event every threshold takes one comparison over the
+       frame into a reused buffer, the whole detector count is a count_nonzero and
+       the ROI counts are gathered from the lit pixels. The valid pixel mask is only
+       recomputed when the streak mask changes. Rows of counts are regions, the
+       whole detector first, columns are thresholds.
+    """
+    def __init__(self, mask, thresholds, rois=None):
+        self.staticMask = np.asarray(mask).ravel() != 0
+        self.valid = self.staticMask.copy()
+        self.roiInd = [np.nonzero(self.staticMask & (np.asarray(roi).ravel() != 0))[0] for roi in (rois or [])]
+        self.thresholds = list(thresholds)
+        self.counts = np.zeros((1 + len(self.roiInd), len(self.thresholds)), dtype=np.int64)
+        self.lit = np.zeros(self.staticMask.size, dtype=bool)
+        self.roiLit = [np.zeros(ind.size, dtype=bool) for ind in self.roiInd]
+        self.lastStreakMask = None
+
+    def setStreakMask(self, streakMask):
+        if streakMask is self.lastStreakMask: return
+        self.lastStreakMask = streakMask
+        if streakMask is None:
+            self.valid[...] = self.staticMask
+        else:
+            np.not_equal(np.asarray(streakMask).ravel(), 0, out=self.valid)
+            np.logical_and(self.valid, self.staticMask, out=self.valid)
+
+    def count(self, calib, streakMask=None):
+        self.setStreakMask(streakMask)
+        flat = np.asarray(calib).ravel()
+        for j, threshold in enumerate(self.thresholds):
+            np.greater(flat, threshold, out=self.lit)
+            np.logical_and(self.lit, self.valid, out=self.lit)
+            self.counts[0, j] = np.count_nonzero(self.lit)
+            for i, ind in enumerate(self.roiInd):
+                np.take(self.lit, ind, out=self.roiLit[i])
+                self.counts[i + 1, j] = np.count_nonzero(self.roiLit[i])
+        return self.counts
+
 class HitFinder:
     def __init__(self,exp,run,detname,evt,detector,litPixelThreshold,
                  streakMask_on,streakMask_sigma,streakMask_width,userMask_path,psanaMask_on,psanaMask_calib,
                  psanaMask_status,psanaMask_edges,psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,
-                 **kwargs):
+                 thresholds=None, rois=None, **kwargs):
         self.exp = exp
         self.run = run
         self.detname = detname
@@ -62,17 +103,20 @@ class HitFinder:
 
         self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
 
+        # litPixelThreshold first, nPixels is the count of the whole detector above it
+        if thresholds is None: thresholds = []
+        self.thresholds = [self.litPixelThreshold] + [t for t in thresholds if t != self.litPixelThreshold]
+        self.counter = LitPixelCounter(self.userPsanaMask, self.thresholds, rois)
+        self.litPixels = self.counter.counts
+
     def findHits(self, calib, evt):
+        """Counts lit pixels without modifying calib"""
         if self.streakMask_on: # make new streak mask
-            self.streakMask = self.StreakMask.getStreakMaskCalib(evt)
-        if self.streakMask is not None:
-            self.combinedMask = self.userPsanaMask * self.streakMask
-        else:
-            self.combinedMask = self.userPsanaMask
+            self.streakMask = self.StreakMask.getStreakMaskCalib(evt, calib)
 
         try:
-            calib *= self.combinedMask
-            self.nPixels = np.where(calib > self.litPixelThreshold)[0].shape[0]
+            self.litPixels = self.counter.count(calib, self.streakMask)
+            self.nPixels = int(self.litPixels[0, 0])
         except:
             self.nPixels = 0
 
@@ -1,16 +1,113 @@
 import numpy as np
-from ImgAlgos.PyAlgos import PyAlgos # peak finding
 import myskbeam
 import time
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
+class RunningBackground(object):
+    """Per pixel mean and variance of the last length frames.
+
+       Frames are kept in a float32 ring buffer, the sums and sums of squares are
+       updated in place when a frame enters or leaves it. Every pruneInterval
+       frames the sums are recomputed from the buffer to remove the rounding
+       error accumulated by the updates.
+    """
+    def __init__(self, numPixels, length, pruneInterval=0, minVariance=1.):
+        self.length = int(length)
+        self.pruneInterval = int(pruneInterval)
+        self.minVariance = minVariance
+        self.buffer = np.zeros((self.length, numPixels), dtype=np.float32)
+        self.sum = np.zeros(numPixels)
+        self.sumsq = np.zeros(numPixels)
+        self.mean = np.zeros(numPixels)
+        self.variance = np.zeros(numPixels)
+        self.tmp = np.zeros(numPixels)
+        self.residual = np.zeros(numPixels)
+        self.above = np.zeros(numPixels, dtype=bool)
+        self.flags = np.zeros(numPixels, dtype=bool)
+        self.count = 0 # frames in the buffer
+        self.next = 0 # slot of the next frame
+        self.numPushed = 0
+
+    def push(self, values):
+        if self.count == self.length: # the oldest frame leaves
+            old = self.buffer[self.next]
+            np.subtract(self.sum, old, out=self.sum)
+            np.multiply(old, old, out=self.tmp)
+            np.subtract(self.sumsq, self.tmp, out=self.sumsq)
+        else:
+            self.count += 1
+        self.buffer[self.next] = values
+        new = self.buffer[self.next]
+        np.add(self.sum, new, out=self.sum)
+        np.multiply(new, new, out=self.tmp)
+        np.add(self.sumsq, self.tmp, out=self.sumsq)
+        self.next = (self.next + 1) % self.length
+        self.numPushed += 1
+        if self.pruneInterval > 0 and self.numPushed % self.pruneInterval == 0:
+            self.prune()
+
+    def keep(self, rows):
+        """Keep only the frames at the given increasing slots of a buffer that never wrapped around"""
+        for j, i in enumerate(rows):
+            if i != j:
+                self.buffer[j] = self.buffer[i]
+        self.count = len(rows)
+        self.next = self.count % self.length
+        self.prune()
+
+    def prune(self):
+        """Recompute the sums from the frames in the buffer"""
+        self.sum[...] = 0
+        self.sumsq[...] = 0
+        for frame in self.buffer[:self.count]:
+            np.add(self.sum, frame, out=self.sum)
+            np.multiply(frame, frame, out=self.tmp)
+            np.add(self.sumsq, self.tmp, out=self.sumsq)
+
+    def update(self):
+        """Mean and variance, at least minVariance, of the frames in the buffer"""
+        n = float(max(self.count, 1))
+        np.divide(self.sum, n, out=self.mean)
+        np.divide(self.sumsq, n, out=self.variance)
+        np.multiply(self.mean, self.mean, out=self.tmp)
+        np.subtract(self.variance, self.tmp, out=self.variance)
+        np.maximum(self.variance, self.minVariance, out=self.variance)
+
+    def score(self, values, nSigma, weight=None):
+        """Mean chi-squared per pixel of values against the background and number of
+           pixels more than nSigma standard deviations above the mean. Pixels with a
+           zero weight are left out.
+        """
+        self.update()
+        np.subtract(values, self.mean, out=self.residual)
+        np.greater(self.residual, 0, out=self.above)
+        np.multiply(self.residual, self.residual, out=self.residual)
+        np.divide(self.residual, self.variance, out=self.residual)
+        # residual is now the chi-squared of every pixel
+        np.greater(self.residual, nSigma ** 2, out=self.flags)
+        np.logical_and(self.above, self.flags, out=self.above)
+        numPixels = values.size
+        if weight is not None:
+            np.multiply(self.residual, weight, out=self.residual)
+            np.greater(weight, 0, out=self.flags)
+            np.logical_and(self.above, self.flags, out=self.above)
+            numPixels = np.count_nonzero(self.flags)
+        return self.residual.sum() / max(numPixels, 1), np.count_nonzero(self.above)
+
 class HitFinder_chiSquared:
+    """Scores every event against a running background of the previous misses.
+
+       chiSquared is the mean over the unmasked pixels of (calib - mean)^2 / variance
+       and nPixels the number of pixels more than nSigma standard deviations above
+       the mean. Events with chiSquared above chiSquaredThreshold are hits and are
+       kept out of the background.
+    """
     def __init__(self,exp,run,detname,evt,detector,pruneInterval,
                  streakMask_on,streakMask_sigma,streakMask_width,userMask_path,psanaMask_on,psanaMask_calib,
                  psanaMask_status,psanaMask_edges,psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,
-                 **kwargs):
+                 bufferLength=60, nSigma=5., chiSquaredThreshold=1.5, minFrames=10, **kwargs):
         self.exp = exp
         self.run = run
         self.detname = detname
@@ -33,7 +130,6 @@ class HitFinder_chiSquared:
         self.psanaMask = None
         self.streakMask = None
         self.userPsanaMask = None
-        self.combinedMask = None
 
         # Make user mask
         if self.userMask_path is not None:
@@ -52,45 +148,49 @@ class HitFinder_chiSquared:
         if self.psanaMask is not None:
             self.userPsanaMask *= self.psanaMask
 
-        # Powder of hits and misses
-        self.powderHits = np.zeros_like(self.userPsanaMask)
-        self.powderMisses = np.zeros_like(self.userPsanaMask)
-
-        self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
-
-        self.buffer_max_len = 120
+        if self.streakMask_on:
+            self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
 
-        # Digest initial events
-        self.digestInitialEvents()
+        self.nSigma = nSigma
+        self.chiSquaredThreshold = chiSquaredThreshold
+        self.minFrames = minFrames
+        # statistics are only kept for the unmasked pixels
+        self.ind = np.nonzero(self.userPsanaMask.ravel())[0]
+        self.background = RunningBackground(self.ind.size, bufferLength, max(pruneInterval, 0))
+        self.values = np.zeros(self.ind.size, dtype=np.float32)
+        self.weight = np.ones(self.ind.size)
+        self.chiSquared = 0.
+        self.nPixels = 0
+        self.isHit = False
 
-    def digestInitialEvents(self):
+    def digestInitialEvents(self, frames):
+        """Fill the background with calibrated frames, e.g. the next events of a rank.
+           Frames scoring as hits are left out.
         """
-        Make a stack of calibrated images of length buffer_max_len
-        """
-        counter = 0
-        for t in range(self.buffer_max_len):
-            evt = self.run.event(t)
-            print "Rank %d digested %d of %d frames" % (self.rank, counter, self.buffer_max_len)
-            # Create masked calib
-            calib = myDetList[detNum].calib_data(evt)
-            if calib is None:
-                continue
-            calib *= myDetList[detNum].spiMask #self.myMask[detNum]
-            self.bg_buffer[detNum].append(calib.copy())
-            counter += 1
-
-        print "Rank %d has %d total frames" % (self.rank, counter)
+        for calib in frames:
+            if calib is None: continue
+            np.take(np.asarray(calib, dtype=np.float32).ravel(), self.ind, out=self.values)
+            self.background.push(self.values)
+        # frames are scored against the background of all of them, a small background
+        # scored one frame at a time overestimates the chi-squared of misses
+        scores = [self.background.score(frame, self.nSigma)[0] for frame in self.background.buffer[:self.background.count]]
+        self.background.keep(np.nonzero(np.array(scores) <= self.chiSquaredThreshold)[0])
 
     def findHits(self, calib, evt):
-        if self.streakMask_on: # make new streak mask
-            self.streakMask = self.StreakMask.getStreakMaskCalib(evt)
-        if self.streakMask is not None:
-            self.combinedMask = self.userPsanaMask * self.streakMask
-        else:
-            self.combinedMask = self.userPsanaMask
+        """Scores calib, which is not modified, and adds it to the background if it is not a hit"""
+        np.take(np.asarray(calib, dtype=np.float32).ravel(), self.ind, out=self.values)
+        weight = None
+        if self.streakMask_on: # streak pixels do not count in the score
+            self.streakMask = self.StreakMask.getStreakMaskCalib(evt, calib)
+            if self.streakMask is not None:
+                np.take(np.asarray(self.streakMask, dtype=np.float64).ravel(), self.ind, out=self.weight)
+                weight = self.weight
 
-        try:
-            calib *= self.combinedMask
-            self.nPixels = np.where(calib > self.litPixelThreshold)[0].shape[0]
-        except:
-            self.nPixels = 0
\ No newline at end of file
+        if self.background.count < self.minFrames:
+            # not enough frames for a background yet
+            self.chiSquared, self.nPixels, self.isHit = 0., 0, False
+        else:
+            self.chiSquared, self.nPixels = self.background.score(self.values, self.nSigma, weight)
+            self.isHit = self.chiSquared > self.chiSquaredThreshold
+        if not self.isHit:
+            self.background.push(self.values)
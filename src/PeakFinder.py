@@ -1,9 +1,13 @@
 import numpy as np
 from ImgAlgos.PyAlgos import PyAlgos # peak finding
 import myskbeam
+import peakRecord
+from PowderAccumulator import PowderAccumulator
 import time
 import psana
-from pyimgalgos.RadialBkgd import RadialBkgd, polarization_factor
+from fastBackground import RadialBackground
+from medianBackground import MedianBackground
+from panelParallel import PanelGroupFinder
 from pyimgalgos.MedianFilter import median_filter_ndarr
 
 def str2bool(v):
@@ -14,7 +18,10 @@ class PeakFinder:
                  hitParam_alg_amax_thr,hitParam_alg_atot_thr,hitParam_alg_son_min,
                  streakMask_on,streakMask_sigma,streakMask_width,userMask_path,psanaMask_on,psanaMask_calib,
                  psanaMask_status,psanaMask_edges,psanaMask_central,psanaMask_unbond,psanaMask_unbondnrs,
-                 medianFilterOn=0, medianRank=5, radialFilterOn=0, distance=0.0, windows=None, **kwargs):
+                 medianFilterOn=0, medianRank=5, radialFilterOn=0, distance=0.0, windows=None, context=None,
+                 streakMask_tolerance=0., streakMask_maxAge=1, powderMinPeaks=15, powderFloat32=False,
+                 medianFast=0, medianThreads=1, peakThreads=1, powder=True, **kwargs):
+        self.context = context # psanaWhisperer.RunContext shared with the caller
         self.exp = exp
         self.run = run
         self.detname = detname
@@ -42,6 +49,9 @@ class PeakFinder:
 
         self.medianFilterOn = medianFilterOn
         self.medianRank = medianRank
+        self.medianBackground = None
+        if medianFast:
+            self.medianBackground = MedianBackground(medianRank, medianThreads)
         self.radialFilterOn = radialFilterOn
         self.distance = distance
 
@@ -70,11 +80,28 @@ class PeakFinder:
         if self.psanaMask is not None:
             self.userPsanaMask *= self.psanaMask
 
-        # Powder of hits and misses
-        self.powderHits = np.zeros_like(self.userPsanaMask)
-        self.powderMisses = np.zeros_like(self.userPsanaMask)
+        # Powder of hits and misses, powderMinPeaks < 0 uses the hit criteria of the cxi file
+        self.powderMinPeaks = powderMinPeaks
+        self.hitMinPeaks = kwargs.get("minNumPeaks", 15)
+        self.hitMaxPeaks = kwargs.get("maxNumPeaks", 2048)
+        self.hitMinRes = kwargs.get("minResCutoff", 0)
+        self.hitPowder = self.missPowder = self.powderHits = self.powderMisses = None
+        if powder:
+            powderDtype = np.float32 if powderFloat32 else np.float64
+            self.hitPowder = PowderAccumulator(self.userPsanaMask.shape, powderDtype)
+            self.missPowder = PowderAccumulator(self.userPsanaMask.shape, powderDtype)
+            self.powderHits = self.hitPowder.max # updated in place
+            self.powderMisses = self.missPowder.max
 
-        self.alg = PyAlgos(windows=self.windows, mask=self.userPsanaMask, pbits=0)
+        if peakThreads > 1 and self.windows is None:
+            # groups of panels searched concurrently, see panelParallel
+            self.alg = PanelGroupFinder(lambda mask: PyAlgos(mask=mask, pbits=0), self.userPsanaMask, peakThreads)
+        else:
+            self.alg = PyAlgos(windows=self.windows, mask=self.userPsanaMask, pbits=0)
+        # mask currently set in PyAlgos, see updateCombinedMask
+        self.combinedMask = self.userPsanaMask.copy()
+        self.lastStreakMask = None
+        self.lastStreakMaskSource = None # streak mask array combinedMask was last built from
         # set peak-selector parameters:
         self.alg.set_peak_selection_pars(npix_min=self.npix_min, npix_max=self.npix_max, \
                                         amax_thr=self.amax_thr, atot_thr=self.atot_thr, \
@@ -98,7 +125,8 @@ class PeakFinder:
             self.hitParam_alg4_dr = kwargs["alg4_dr"]
 
         self.maxNumPeaks = 2048
-        self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma)
+        self.StreakMask = myskbeam.StreakMask(self.det, evt, width=self.streakMask_width, sigma=self.streakMask_sigma,
+                                              tolerance=streakMask_tolerance, maxAge=streakMask_maxAge)
         self.cx, self.cy = self.det.point_indexes(evt, pxy_um=(0, 0))
         self.iX = np.array(self.det.indexes_x(evt), dtype=np.int64)
         self.iY = np.array(self.det.indexes_y(evt), dtype=np.int64)
@@ -112,7 +140,22 @@ class PeakFinder:
             self.setupRadialBackground()
             self.updatePolarizationFactor()
 
+        # radius in assembled pixels of every pixel centre, per event maxRes is a gather
+        self.radiusMap = np.sqrt((self.iX + 0.5 - self.cx) ** 2 + (self.iY + 0.5 - self.cy) ** 2).astype(np.float32)
+        self.peakRadius = np.zeros((0,), dtype=np.float32)
+        self.resolutionMap = None
+        self.resolutionKey = None
+
     def setupExperiment(self):
+        if self.context is not None:
+            self.ds = self.context.ds
+            self.run = self.context.run
+            self.times = self.context.times
+            self.eventTotal = self.context.eventTotal
+            self.env = self.context.env
+            self.evt = self.context.getFirstEvent()
+            self.det = self.context.det
+            return
         self.ds = psana.DataSource('exp=' + str(self.exp) + ':run=' + str(self.run) + ':idx')
         self.run = self.ds.runs().next()
         self.times = self.run.times()
@@ -123,7 +166,10 @@ class PeakFinder:
         self.det.do_reshape_2d_to_3d(flag=True)
 
     def setupRadialBackground(self):
-        self.geo = self.det.geometry(self.run)  # self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
+        if self.context is not None:
+            self.geo = self.context.getGeometry()
+        else:
+            self.geo = self.det.geometry(self.run)  # self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
         self.xarr, self.yarr, self.zarr = self.geo.get_pixel_coords()
         self.ix = self.det.indexes_x(self.evt)
         self.iy = self.det.indexes_y(self.evt)
@@ -136,37 +182,64 @@ class PeakFinder:
             self.iX = np.expand_dims(self.iX, axis=0)
             self.iY = np.expand_dims(self.iY, axis=0)
         self.mask = self.geo.get_pixel_mask( mbits=0377)  # mask for 2x1 edges, two central columns, and unbound pixels with their neighbours
-        self.rb = RadialBkgd(self.xarr, self.yarr, mask=self.mask, radedges=None, nradbins=100,
-                             phiedges=(0, 360), nphibins=1)
+        # radial bins and valid pixels are computed once, see fastBackground
+        self.rb = RadialBackground(self.xarr, self.yarr, mask=self.mask, nradbins=100)
 
     def updatePolarizationFactor(self):
-        self.pf = polarization_factor(self.rb.pixel_rad(), self.rb.pixel_phi(), self.distance * 1e6)  # convert to um
+        self.rb.setDistance(self.distance * 1e6)  # convert to um
+
+    def updateCombinedMask(self):
+        """Keeps combinedMask equal to userPsanaMask times the streak mask.
+           Only panels where the streak mask changed are recomputed and the
+           mask is only set in PyAlgos when it changed.
+        """
+        numPanels = self.combinedMask.shape[0]
+        # StreakMask hands back the same array while it reuses a mask
+        if self.streakMask is not None and self.streakMask is self.lastStreakMaskSource: return
+        self.lastStreakMaskSource = self.streakMask
+        if self.streakMask is None:
+            if self.lastStreakMask is None: return
+            self.combinedMask[...] = self.userPsanaMask
+            self.lastStreakMask = None
+        else:
+            if self.lastStreakMask is None:
+                self.lastStreakMask = np.ones_like(self.streakMask)
+            changed = (self.streakMask != self.lastStreakMask).reshape(numPanels, -1).any(axis=1)
+            panels = np.nonzero(changed)[0]
+            if panels.size == 0: return
+            self.combinedMask[panels] = self.userPsanaMask[panels] * self.streakMask[panels]
+            self.lastStreakMask[panels] = self.streakMask[panels]
+        self.alg.set_mask(self.combinedMask) # This doesn't work reliably
+
+    def setStreakMask(self, streakMask):
+        """Use a streak mask made by another PeakFinder, such as the one that preprocessed calib"""
+        self.streakMask = streakMask
+        self.updateCombinedMask()
 
     def findPeaks(self, calib, evt):
+        calib = self.preprocess(calib, evt)
+        self.peakFind(calib)
 
+    def preprocess(self, calib, evt):
+        """Streak mask and background subtraction, returns the corrected calib"""
         if self.streakMask_on: # make new streak mask
-            self.streakMask = self.StreakMask.getStreakMaskCalib(evt)
+            self.streakMask = self.StreakMask.getStreakMaskCalib(evt, calib)
 
         # Apply background correction
         if self.medianFilterOn:
-            calib -= median_filter_ndarr(calib, self.medianRank)
+            if self.medianBackground is not None:
+                self.medianBackground.subtract(calib)
+            else:
+                calib -= median_filter_ndarr(calib, self.medianRank)
 
         if self.radialFilterOn:
-            self.pf.shape = calib.shape  # FIXME: shape is 1d
-            calib = self.rb.subtract_bkgd(calib * self.pf)
-            calib.shape = self.userPsanaMask.shape  # FIXME: shape is 1d
+            calib = self.rb.subtract(calib) # float32 buffer reused for the next event
 
-        if self.streakMask is not None:
-            self.combinedMask = self.userPsanaMask * self.streakMask
-        else:
-            self.combinedMask = self.userPsanaMask
-        # set new mask
-        #self.alg = PyAlgos(windows=self.windows, mask=self.combinedMask, pbits=0)
-        # set peak-selector parameters:
-        #self.alg.set_peak_selection_pars(npix_min=self.npix_min, npix_max=self.npix_max, \
-        #                                amax_thr=self.amax_thr, atot_thr=self.atot_thr, \
-        #                                son_min=self.son_min)
-        self.alg.set_mask(self.combinedMask) # This doesn't work reliably
+        self.updateCombinedMask()
+        return calib
+
+    def peakFind(self, calib):
+        """Peaks of a preprocessed calib, see preprocess"""
         # set algorithm specific parameters
         if self.algorithm == 1:
             # v1 - aka Droplet Finder - two-threshold peak-finding algorithm in restricted region
@@ -187,18 +260,41 @@ class PeakFinder:
         self.numPeaksFound = self.peaks.shape[0]
 
         if self.numPeaksFound > 0:
-            cenX = self.iX[np.array(self.peaks[:, 0], dtype=np.int64), np.array(self.peaks[:, 1], dtype=np.int64), np.array(
-                self.peaks[:, 2], dtype=np.int64)] + 0.5
-            cenY = self.iY[np.array(self.peaks[:, 0], dtype=np.int64), np.array(self.peaks[:, 1], dtype=np.int64), np.array(
-                self.peaks[:, 2], dtype=np.int64)] + 0.5
-            self.maxRes = getMaxRes(cenX, cenY, self.cx, self.cy)
+            ind = self.peaks[:, :3].astype(np.int64)
+            self.peakRadius = self.radiusMap[ind[:, 0], ind[:, 1], ind[:, 2]]
+            self.maxRes = self.peakRadius.max()
         else:
+            self.peakRadius = np.zeros((0,), dtype=np.float32)
             self.maxRes = 0
 
-        if self.numPeaksFound >= 15:
-            self.powderHits = np.maximum(self.powderHits, calib)
+        if self.hitPowder is None: return
+        if self.isPowderHit():
+            self.hitPowder.add(calib)
         else:
-            self.powderMisses = np.maximum(self.powderMisses, calib)
+            self.missPowder.add(calib)
+
+    def isPowderHit(self):
+        if self.powderMinPeaks >= 0:
+            return self.numPeaksFound >= self.powderMinPeaks
+        return self.numPeaksFound >= self.hitMinPeaks and \
+               self.numPeaksFound <= self.hitMaxPeaks and \
+               self.maxRes >= self.hitMinRes
+
+    def getResolutionMap(self, pixelSize, distance, wavelength):
+        """Resolution in Angstrom of every pixel, recomputed only when the arguments change"""
+        key = (pixelSize, distance, wavelength)
+        if self.resolutionMap is None or key != self.resolutionKey:
+            self.resolutionMap = peakRecord.radiusToResolution(self.radiusMap, pixelSize, distance, wavelength)
+            self.resolutionKey = key
+        return self.resolutionMap
+
+    def getPeakResolution(self, pixelSize, distance, wavelength):
+        """Resolution in Angstrom of the peaks of the last event"""
+        return peakRecord.radiusToResolution(self.peakRadius, pixelSize, distance, wavelength)
+
+    def getPeakRecords(self):
+        """Peaks of the last event as compact records, at most maxNumPeaks of them"""
+        return peakRecord.pack(self.peaks[:self.maxNumPeaks])
 
 def getMaxRes(posX, posY, centerX, centerY):
     maxRes = np.max(np.sqrt((posX - centerX) ** 2 + (posY - centerY) ** 2))
@@ -0,0 +1,73 @@
+import numpy as np
+
+class PowderAccumulator(object):
+    """Running max, sum, sum of squares and count of frames, updated in place.
+
+       max starts at zero like the powders made with np.maximum did.
+    """
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max = np.zeros(self.shape, dtype=self.dtype)
+        self.sum = np.zeros(self.shape, dtype=self.dtype)
+        self.sumsq = np.zeros(self.shape, dtype=self.dtype)
+        self.tmp = np.zeros(self.shape, dtype=self.dtype)
+        self.count = 0
+
+    def add(self, frame):
+        np.maximum(self.max, frame, out=self.max)
+        np.add(self.sum, frame, out=self.sum)
+        np.multiply(frame, frame, out=self.tmp)
+        np.add(self.sumsq, self.tmp, out=self.sumsq)
+        self.count += 1
+
+    def merge(self, other):
+        np.maximum(self.max, other.max, out=self.max)
+        np.add(self.sum, other.sum, out=self.sum)
+        np.add(self.sumsq, other.sumsq, out=self.sumsq)
+        self.count += other.count
+
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    def sigma(self):
+        mean = self.mean()
+        var = self.sumsq / max(self.count, 1) - mean * mean
+        return np.sqrt(np.maximum(var, 0))
+
+def reduceAccumulators(comm, acc, root=0):
+    """Merge the accumulators of all ranks of comm with MPI reductions.
+       Ranks without an accumulator (acc is None) take part with an empty one.
+       Returns the merged accumulator on root and None on the other ranks.
+    """
+    from mpi4py import MPI
+    layouts = comm.allgather(None if acc is None else (acc.shape, acc.dtype.str))
+    layouts = [layout for layout in layouts if layout is not None]
+    if not layouts: return None
+    if acc is None:
+        acc = PowderAccumulator(*layouts[0])
+    merged = None
+    if comm.Get_rank() == root:
+        merged = PowderAccumulator(acc.shape, acc.dtype)
+    for name, op in [('max', MPI.MAX), ('sum', MPI.SUM), ('sumsq', MPI.SUM)]:
+        comm.Reduce(getattr(acc, name), getattr(merged, name) if merged is not None else None, op=op, root=root)
+    count = comm.reduce(acc.count, op=MPI.SUM, root=root)
+    if merged is not None:
+        merged.count = count
+    return merged
+
+def addToMessage(md, acc, name):
+    """Add an accumulator to an mpidata, its max is sent as name like the plain powders were"""
+    md.addarray(name, acc.max)
+    md.addarray(name + 'Sum', acc.sum)
+    md.addarray(name + 'Sumsq', acc.sumsq)
+    setattr(md.small, name + 'Count', acc.count)
+
+def fromMessage(md, name):
+    """Copy an accumulator out of a received mpidata"""
+    acc = PowderAccumulator(getattr(md, name).shape, getattr(md, name).dtype)
+    acc.max[...] = getattr(md, name)
+    acc.sum[...] = getattr(md, name + 'Sum')
+    acc.sumsq[...] = getattr(md, name + 'Sumsq')
+    acc.count = getattr(md.small, name + 'Count')
+    return acc
@@ -0,0 +1,212 @@
+import time
+import zlib
+import h5py
+import numpy as np
+
+def fillRow(rows, i, val):
+    """Copy val into row i of a buffer, arrays shorter than the row are zero padded.
+       Values that can not be stored, such as missing epics variables, are saved as 0.
+    """
+    if val is None: val = 0
+    if rows.ndim == 1:
+        try:
+            rows[i] = val
+        except:
+            rows[i] = 0
+    else:
+        val = np.asarray(val)
+        n = val.shape[0] if val.ndim > 0 else 0
+        rows[i, :n] = val
+        rows[i, n:] = 0
+
+class EventRowBuffer(object):
+    """Buffers rows of datasets indexed by event number and commits them to hdf5
+       in contiguous blocks.
+
+       Rows may arrive in any order. On flush they are sorted by event number
+       and every run of consecutive events is written with a single slice
+       assignment per dataset.
+    """
+    def __init__(self, h5file, datasets, maxRows=256, flushInterval=10.):
+        self.h5file = h5file
+        self.datasets = list(datasets)
+        self.maxRows = maxRows
+        self.flushInterval = flushInterval # seconds
+        self.rows = {}
+        for name in self.datasets:
+            ds = h5file[name]
+            self.rows[name] = np.zeros((maxRows,) + ds.shape[1:], dtype=ds.dtype)
+        self.events = np.zeros(maxRows, dtype=np.int64)
+        self.numRows = 0
+        self.lastFlush = time.time()
+
+    def append(self, eventNum, values):
+        """Add the row of eventNum, values maps dataset name to a scalar or an array.
+           Arrays shorter than the row are zero padded.
+        """
+        i = self.numRows
+        self.events[i] = eventNum
+        for name in self.datasets:
+            fillRow(self.rows[name], i, values.get(name, 0))
+        self.numRows += 1
+        if self.numRows == self.maxRows or time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        n = self.numRows
+        if n > 0:
+            order = np.argsort(self.events[:n], kind='mergesort')
+            events = self.events[:n][order]
+            # split into runs of consecutive event numbers
+            breaks = np.nonzero(np.diff(events) != 1)[0] + 1
+            starts = np.concatenate(([0], breaks))
+            stops = np.concatenate((breaks, [n]))
+            for name in self.datasets:
+                ds = self.h5file[name]
+                block = self.rows[name][:n][order]
+                for a, b in zip(starts, stops):
+                    ds[events[a]:events[b-1]+1] = block[a:b]
+            self.h5file.flush()
+        self.numRows = 0
+        self.lastFlush = time.time()
+
+class ColumnBuffer(object):
+    """Write-behind buffer for per-hit values that are appended one row at a time.
+
+       Each dataset is a column held in memory. Rows are cheap to append and all
+       columns are committed with one block write each when maxRows rows are
+       pending or flushInterval seconds have passed since the last flush.
+       Rows are written starting at index start of every dataset, which must
+       already be large enough to hold them.
+    """
+    def __init__(self, h5file, datasets, start=0, maxRows=128, flushInterval=10., flushFile=True):
+        self.h5file = h5file
+        self.datasets = list(datasets)
+        self.start = start
+        self.maxRows = maxRows
+        self.flushInterval = flushInterval # seconds, None to flush only when full
+        self.flushFile = flushFile # set to False for parallel (mpio) files where h5 flush is collective
+        self.columns = {}
+        for name in self.datasets:
+            ds = h5file[name]
+            self.columns[name] = np.zeros((maxRows,) + ds.shape[1:], dtype=ds.dtype)
+        self.numRows = 0
+        self.lastFlush = time.time()
+
+    def append(self, values):
+        """Add a row, values maps dataset name to a scalar or an array"""
+        i = self.numRows
+        for name in self.datasets:
+            fillRow(self.columns[name], i, values.get(name, 0))
+        self.numRows += 1
+        if self.numRows == self.maxRows or \
+           (self.flushInterval is not None and time.time() - self.lastFlush >= self.flushInterval):
+            self.flush()
+
+    def flush(self):
+        n = self.numRows
+        if n > 0:
+            for name in self.datasets:
+                self.h5file[name][self.start:self.start+n] = self.columns[name][:n]
+            if self.flushFile: self.h5file.flush()
+        self.start += n
+        self.numRows = 0
+        self.lastFlush = time.time()
+
+class CapacityManager(object):
+    """Grows a set of resizable datasets together along their first axis.
+
+       Capacity grows geometrically, or straight to a projected final size when
+       one is given, so the number of resizes is logarithmic in the number of
+       rows. trim() crops all datasets to the number of rows actually used.
+    """
+    def __init__(self, h5file, datasets, growthFactor=2., minCapacity=100, maxCapacity=None):
+        self.h5file = h5file
+        self.datasets = list(datasets)
+        self.growthFactor = growthFactor
+        self.minCapacity = minCapacity
+        self.maxCapacity = maxCapacity
+        self.capacity = min([h5file[name].shape[0] for name in self.datasets])
+        self.numResizes = 0
+
+    def resize(self, numRows):
+        for name in self.datasets:
+            ds = self.h5file[name]
+            ds.resize((numRows,) + ds.shape[1:])
+        self.capacity = numRows
+
+    def reserve(self, numRows, projected=0):
+        """Make room for numRows rows, returns True if the datasets were resized.
+           projected is an estimate of the final number of rows, e.g. from the hit rate.
+        """
+        if numRows <= self.capacity: return False
+        newCapacity = max(numRows, int(self.capacity * self.growthFactor), int(projected), self.minCapacity)
+        if self.maxCapacity is not None:
+            newCapacity = max(min(newCapacity, self.maxCapacity), numRows)
+        self.resize(newCapacity)
+        self.numResizes += 1
+        return True
+
+    def trim(self, numRows):
+        self.resize(numRows)
+
+def compressFrame(img, dtype=np.float32, level=1):
+    """Deflate a frame the way the hdf5 gzip filter does, for a dataset chunked
+       one frame at a time. Returns the compressed chunk as uint8.
+    """
+    img = np.ascontiguousarray(img, dtype=dtype)
+    return np.frombuffer(zlib.compress(img.tobytes(), level), dtype=np.uint8)
+
+def writeCompressedFrame(ds, ind, chunk):
+    """Store a chunk made by compressFrame as frame ind of ds without recompressing it"""
+    ds.id.write_direct_chunk((ind,) + (0,) * (len(ds.shape) - 1), np.ascontiguousarray(chunk))
+
+def getSchema(h5file, datasets):
+    """Layout of datasets, enough to create empty resizable copies of them in another file"""
+    schema = []
+    for name in datasets:
+        ds = h5file[name]
+        schema.append((name, ds.dtype, ds.shape[1:], ds.chunks, ds.compression, ds.compression_opts))
+    return schema
+
+def createDatasets(h5file, schema):
+    """Create empty datasets that grow along their first axis from a schema made by getSchema"""
+    for name, dtype, rowShape, chunks, compression, compression_opts in schema:
+        h5file.create_dataset(name, (0,) + rowShape, maxshape=(None,) + rowShape, dtype=dtype,
+                              chunks=chunks or True, compression=compression,
+                              compression_opts=compression_opts)
+
+def contiguousRuns(dst, src):
+    """Split a mapping of rows dst[i] <- src[i] into runs that are consecutive in both.
+       Returns a list of (dst start, src start, length).
+    """
+    dst = np.asarray(dst, dtype=np.int64)
+    src = np.asarray(src, dtype=np.int64)
+    if dst.size == 0: return []
+    order = np.argsort(dst, kind='mergesort')
+    dst, src = dst[order], src[order]
+    breaks = np.nonzero((np.diff(dst) != 1) | (np.diff(src) != 1))[0] + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [dst.size]))
+    return [(dst[a], src[a], b - a) for a, b in zip(starts, stops)]
+
+def replaceWithVirtual(h5file, name, numRows, sources, fillvalue=0):
+    """Replace dataset name by a virtual dataset of numRows rows mapped onto other files.
+
+       sources is a list of (file name, number of rows in the file, runs) with runs
+       as returned by contiguousRuns. The source dataset has the same name in each file.
+       Use file names relative to the directory of h5file so the files can be moved together.
+    """
+    ds = h5file[name]
+    dtype, rowShape, attrs = ds.dtype, ds.shape[1:], dict(ds.attrs)
+    layout = h5py.VirtualLayout(shape=(numRows,) + rowShape, dtype=dtype)
+    for fname, srcRows, runs in sources:
+        if not runs: continue
+        vsource = h5py.VirtualSource(fname, name, shape=(srcRows,) + rowShape)
+        for dstStart, srcStart, length in runs:
+            layout[dstStart:dstStart+length] = vsource[srcStart:srcStart+length]
+    del h5file[name]
+    ds = h5file.create_virtual_dataset(name, layout, fillvalue=fillvalue)
+    for key, val in attrs.items():
+        ds.attrs[key] = val
+    return ds
@@ -0,0 +1,77 @@
+import time
+import numpy as np
+
+class EventDispenser(object):
+    """Hands out batches of event numbers to workers on demand.
+
+       Workers ask for more work when they finish a batch and report how long
+       the batch took. The batch size is chosen so that a batch takes roughly
+       targetTime seconds given the measured cost per event, but never more
+       than a fair share of the remaining events so that the tail of the run
+       stays balanced across workers.
+    """
+    def __init__(self, numEvents, numWorkers, targetTime=1.0, minBatch=1, maxBatch=100, decay=0.9):
+        self.numEvents = numEvents
+        self.numWorkers = max(numWorkers, 1)
+        self.targetTime = targetTime
+        self.minBatch = max(minBatch, 1)
+        self.maxBatch = max(maxBatch, self.minBatch)
+        self.decay = decay # forgetting factor of the running cost estimate
+        self.nextEvent = 0
+        self.sumTime = 0.
+        self.sumEvents = 0.
+
+    def update(self, batchSize, batchTime):
+        """Fold the time a worker took for its last batch into the cost estimate"""
+        if batchSize <= 0: return
+        self.sumTime = self.decay * self.sumTime + batchTime
+        self.sumEvents = self.decay * self.sumEvents + batchSize
+
+    def getCostPerEvent(self):
+        if self.sumEvents <= 0: return None
+        return self.sumTime / self.sumEvents
+
+    def getBatchSize(self, lastBatchSize=0):
+        remaining = self.numEvents - self.nextEvent
+        if remaining <= 0: return 0
+        cost = self.getCostPerEvent()
+        if cost is None or cost <= 0:
+            batchSize = self.minBatch
+        else:
+            batchSize = int(self.targetTime / cost)
+        # grow at most twice the last batch of this worker, so early optimistic estimates do no harm
+        batchSize = min(batchSize, 2 * max(lastBatchSize, self.minBatch))
+        # guided self-scheduling: shrink batches towards the end of the run
+        fairShare = int(np.ceil(remaining / (2. * self.numWorkers)))
+        batchSize = min(batchSize, fairShare, self.maxBatch)
+        batchSize = max(batchSize, self.minBatch)
+        return min(batchSize, remaining)
+
+    def nextBatch(self, batchSize=0, batchTime=0.):
+        """Returns (start, stop) of the next batch, start == stop when the run is done"""
+        self.update(batchSize, batchTime)
+        start = self.nextEvent
+        self.nextEvent += self.getBatchSize(batchSize)
+        return (start, self.nextEvent)
+
+    def done(self):
+        return self.nextEvent >= self.numEvents
+
+def requestEvents(send, recv):
+    """Generator run on a worker that yields event numbers handed out by the master.
+
+       send(batchSize, batchTime) posts a work request to the master and recv()
+       returns the (start, stop) reply. The time spent in the caller's loop body
+       is included in batchTime since the generator is suspended while it runs.
+    """
+    batchSize = 0
+    batchTime = 0.
+    while True:
+        send(batchSize, batchTime)
+        start, stop = recv()
+        if stop <= start: return
+        tic = time.time()
+        for nevent in range(start, stop):
+            yield nevent
+        batchSize = stop - start
+        batchTime = time.time() - tic
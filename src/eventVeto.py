@@ -0,0 +1,70 @@
+import numpy as np
+
+# Veto flag of an event, stored in /entry_1/result_1/vetoAll
+PASSED = 0 # went through peak finding
+VETOED = 1 # skipped by the veto
+AUDITED = 2 # vetoed but processed anyway to measure the false negative rate
+
+class LitPixelVeto(object):
+    """Cheap decision whether an event is worth full peak finding.
+
+       Counts the pixels of a subsampled raw frame, every step-th row and column
+       of every panel, that are more than threshold ADU above the pedestal.
+       Events with fewer than minLit such pixels are vetoed, except for a random
+       auditFraction of them which are processed anyway so that the fraction of
+       vetoed hits can be measured.
+    """
+    def __init__(self, pedestal, threshold, minLit, step=4, mask=None, auditFraction=0.01, seed=None):
+        shape = pedestal.shape
+        panels = np.zeros(shape, dtype=bool)
+        panels[..., ::step, ::step] = True
+        if mask is not None:
+            panels &= np.asarray(mask).reshape(shape) > 0
+        self.ind = np.nonzero(panels.ravel())[0]
+        self.pedestal = np.asarray(pedestal, dtype=np.float32).ravel()[self.ind]
+        self.threshold = threshold
+        self.minLit = minLit
+        self.auditFraction = auditFraction
+        self.rng = np.random.RandomState(seed)
+        self.values = np.zeros(self.ind.size, dtype=np.float32)
+        self.lit = np.zeros(self.ind.size, dtype=bool)
+        self.numLit = 0
+
+    def countLit(self, raw):
+        np.subtract(np.asarray(raw).ravel().take(self.ind), self.pedestal, out=self.values)
+        np.greater(self.values, self.threshold, out=self.lit)
+        self.numLit = np.count_nonzero(self.lit)
+        return self.numLit
+
+    def getFlag(self, raw):
+        """Returns PASSED, VETOED or AUDITED for the raw frame of an event"""
+        if raw is None or self.countLit(raw) >= self.minLit:
+            return PASSED
+        if self.rng.uniform() < self.auditFraction:
+            return AUDITED
+        return VETOED
+
+def summarize(veto, isHit, auditFraction):
+    """Veto rate and false negative rate from the per event flags, unprocessed events are negative.
+
+       falseNegativeRate is the estimated fraction of the hits that were vetoed, the
+       vetoed hits being estimated as numAuditedHits / auditFraction. It is -1 without
+       audit. falseOmissionRate is the fraction of the audited events that were hits.
+    """
+    veto = np.asarray(veto)
+    isHit = np.asarray(isHit, dtype=bool)
+    numProcessed = np.count_nonzero(veto >= 0)
+    numVetoed = np.count_nonzero((veto == VETOED) | (veto == AUDITED))
+    numAudited = np.count_nonzero(veto == AUDITED)
+    numAuditedHits = np.count_nonzero((veto == AUDITED) & isHit)
+    numPassedHits = np.count_nonzero((veto == PASSED) & isHit)
+    falseNegativeRate = -1.
+    if auditFraction > 0:
+        numVetoedHits = numAuditedHits / float(auditFraction)
+        falseNegativeRate = numVetoedHits / max(numVetoedHits + numPassedHits, 1.)
+    return {'vetoRate': numVetoed / float(max(numProcessed, 1)),
+            'numAudited': numAudited,
+            'numAuditedHits': numAuditedHits,
+            'numPassedHits': numPassedHits,
+            'falseNegativeRate': falseNegativeRate,
+            'falseOmissionRate': numAuditedHits / float(max(numAudited, 1))}
@@ -0,0 +1,69 @@
+import numpy as np
+
+def polarizationFactor(rad, phi, z):
+    """Per pixel polarization correction for a detector perpendicular to the beam,
+       rad and z in the same units and phi in radians. Same as pyimgalgos polarization_factor.
+    """
+    theta = np.arctan2(rad, z)
+    sxc = np.sin(theta) * np.cos(phi)
+    pol = 1 - sxc * sxc
+    factor = np.zeros_like(pol)
+    np.divide(1., pol, out=factor, where=pol != 0)
+    return factor
+
+class RadialBackground(object):
+    """Radial background subtraction with all geometry work done once.
+
+       Pixels are put in nradbins radial bins between the smallest and the largest
+       radius, with a single azimuthal bin, like RadialBkgd(..., nradbins=100,
+       phiedges=(0,360), nphibins=1). Per event the polarization corrected frame
+       is averaged per bin over the unmasked pixels with one bincount and the
+       bin averages are gathered back and subtracted. Output buffers are reused,
+       so the returned array is only valid until the next call.
+    """
+    def __init__(self, xarr, yarr, mask=None, nradbins=100, distance=None, dtype=np.float32):
+        x = np.asarray(xarr, dtype=np.float64).ravel()
+        y = np.asarray(yarr, dtype=np.float64).ravel()
+        self.shape = np.asarray(xarr).shape
+        self.nbins = nradbins
+        self.dtype = np.dtype(dtype)
+        rad = np.hypot(x, y)
+        rmin, rmax = rad.min(), rad.max()
+        self.ibin = np.floor((rad - rmin) / max(rmax - rmin, 1e-12) * nradbins).astype(np.intp)
+        np.clip(self.ibin, 0, nradbins - 1, out=self.ibin)
+        # masked pixels go to an extra bin, so the average is a single bincount
+        self.countBin = self.ibin.copy()
+        if mask is not None:
+            self.countBin[np.asarray(mask).ravel() == 0] = nradbins
+        count = np.bincount(self.countBin, minlength=nradbins + 1)[:nradbins].astype(np.float64)
+        self.invCount = np.zeros(nradbins)
+        np.divide(1., count, out=self.invCount, where=count > 0)
+        # geometry kept for the polarization correction, see setDistance
+        self.rad = rad.astype(np.float32)
+        self.phi = np.arctan2(y, x).astype(np.float32)
+        self.pf = None
+        if distance is not None:
+            self.setDistance(distance)
+        # buffers reused across events
+        self.corrected = np.zeros(x.size, dtype=self.dtype)
+        self.background = np.zeros(x.size, dtype=self.dtype)
+        self.out = np.zeros(x.size, dtype=self.dtype)
+
+    def setDistance(self, distance):
+        """Polarization correction for a detector at distance, same units as xarr and yarr"""
+        self.pf = polarizationFactor(self.rad, self.phi, distance).astype(self.dtype)
+
+    def getBinAverage(self, corrected):
+        return np.bincount(self.countBin, weights=corrected, minlength=self.nbins + 1)[:self.nbins] * self.invCount
+
+    def subtract(self, nda):
+        """Returns nda times the polarization factor minus its radial average, shaped like nda"""
+        flat = np.asarray(nda).ravel()
+        if self.pf is not None:
+            np.multiply(flat, self.pf, out=self.corrected, casting='unsafe')
+        else:
+            self.corrected[...] = flat
+        average = self.getBinAverage(self.corrected).astype(self.dtype)
+        np.take(average, self.ibin, out=self.background)
+        np.subtract(self.corrected, self.background, out=self.out)
+        return self.out.reshape(np.shape(nda))
@@ -1,6 +1,6 @@
 # Find pixels with photons
 from hitFinderMaster import runmaster
-from hitFinderClient import runclient
+from hitFinderClient import runclient, getThresholds, getRois, hasLitPixelCounts
 
 import h5py, psana
 import numpy as np
@@ -20,7 +20,12 @@ parser.add_argument("-o","--outDir",help="output directory",default="", type=str
 parser.add_argument("-n","--noe",help="number of events, all events=-1",default=-1, type=int)
 parser.add_argument("-a","--algorithm",help="algorithm number",default=2, type=int)
 parser.add_argument("-p","--pruneInterval",help="number of events to update running background",default=-1, type=float)
+parser.add_argument("--bufferLength",help="number of previous misses in the running background of the chi-squared algorithm",default=60, type=int)
+parser.add_argument("--nSigma",help="standard deviations above the running background of a lit pixel in the chi-squared algorithm",default=5., type=float)
+parser.add_argument("--chiSquaredThreshold",help="chi-squared per pixel above which an event is a hit and kept out of the running background",default=1.5, type=float)
 parser.add_argument("-l","--litPixelThreshold",help="number of ADUs to be considered a lit pixel",default=-1, type=float)
+parser.add_argument("--litPixelThresholds",help="comma separated ADU thresholds counted besides litPixelThreshold (e.g. 50,200)",default="", type=str)
+parser.add_argument("--roiMasks",help="comma separated numpy masks of regions of interest with lit pixels counted separately",default="", type=str)
 parser.add_argument("--userMask_path",help="full path to user mask numpy array",default=None, type=str)
 parser.add_argument("--streakMask_on",help="streak mask on",default="False", type=str)
 parser.add_argument("--streakMask_sigma",help="streak mask sigma above background",default=0., type=float)
@@ -32,9 +37,14 @@ parser.add_argument("--psanaMask_edges",help="psana edges on",default="False", t
 parser.add_argument("--psanaMask_central",help="psana central on",default="False", type=str)
 parser.add_argument("--psanaMask_unbond",help="psana unbonded pixels on",default="False", type=str)
 parser.add_argument("--psanaMask_unbondnrs",help="psana unbonded pixel neighbors on",default="False", type=str)
+parser.add_argument("--writeBufferSize", help="number of events buffered in memory before writing the hit metrics",default=256, type=int)
+parser.add_argument("--flushInterval", help="maximum time in seconds buffered results are kept before writing",default=10., type=float)
+parser.add_argument("--statusInterval", help="time in seconds between updates of the status file",default=1., type=float)
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
 args = parser.parse_args()
+if args.algorithm != 2 and (args.litPixelThresholds or args.roiMasks):
+    parser.error("--litPixelThresholds and --roiMasks are only used by the lit pixel hit finder, -a 2")
 
 def getNoe(args):
     runStr = "%04d" % args.run
@@ -79,6 +89,15 @@ if rank == 0:
     myHdf5.flush()
     grp = myHdf5.create_group(grpName)
     myHdf5.create_dataset(grpName+dset_nHits, data=np.ones(numJobs,)*-1, dtype='int')
+    if args.algorithm == 1:
+        myHdf5.create_dataset(grpName+"/chiSquaredAll", data=np.ones(numJobs,)*-1, dtype=float)
+    # lit pixels of the whole detector and every ROI (rows) above every threshold (columns)
+    if hasLitPixelCounts(args):
+        numThresholds, numRois = len(getThresholds(args)), len(getRois(args))
+        ds = myHdf5.create_dataset(grpName+"/litPixelsAll", data=-np.ones((numJobs, 1 + numRois, numThresholds)),
+                                   dtype='int')
+        ds.attrs["thresholds"] = getThresholds(args)
+        ds.attrs["roiMasks"] = args.roiMasks
     myHdf5.flush()
     myHdf5.close()
 
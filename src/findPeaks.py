@@ -1,7 +1,8 @@
 # Find Bragg peaks
-from peakFinderMaster import runmaster
+from peakFinderMaster import runmaster, getEventDatasets, hitDatasets, frameDataset
 from peakFinderClient import runclient
 import psanaWhisperer
+from cxiWriter import getSchema
 import h5py, psana
 import numpy as np
 from mpi4py import MPI
@@ -41,6 +42,8 @@ parser.add_argument("--alg1_dr",help="number of events to process",default=1., t
 parser.add_argument("--streakMask_on",help="streak mask on",default="False", type=str)
 parser.add_argument("--streakMask_sigma",help="streak mask sigma above background",default=0., type=float)
 parser.add_argument("--streakMask_width",help="streak mask width",default=0, type=float)
+parser.add_argument("--streakMask_tolerance",help="drift of the streak region signature above which the streak mask is recomputed",default=0.05, type=float)
+parser.add_argument("--streakMask_maxAge",help="maximum number of events a streak mask is reused for, 1 recomputes it for every event",default=1, type=int)
 parser.add_argument("--userMask_path",help="full path to user mask numpy array",default=None, type=str)
 parser.add_argument("--psanaMask_on",help="psana mask on",default="False", type=str)
 parser.add_argument("--psanaMask_calib",help="psana calib on",default="False", type=str)
@@ -54,6 +57,9 @@ parser.add_argument("--mask",help="static mask",default='', type=str)
 parser.add_argument("-n","--noe",help="number of events to process",default=-1, type=int)
 parser.add_argument("--medianBackground",help="subtract median background",default=0, type=int)
 parser.add_argument("--medianRank",help="median background window size",default=0, type=int)
+parser.add_argument("--medianFast",help="approximate separable median background, see medianBackground",default=0, type=int)
+parser.add_argument("--peakThreads",help="number of threads searching groups of detector panels for peaks",default=1, type=int)
+parser.add_argument("--medianThreads",help="number of threads filtering detector panels with --medianFast",default=1, type=int)
 parser.add_argument("--radialBackground",help="subtract radial background",default=0, type=int)
 #parser.add_argument("--distance",help="detector distance used for radial background",default=0, type=float)
 parser.add_argument("--sample",help="sample name (e.g. lysozyme)",default='', type=str)
@@ -66,15 +72,35 @@ parser.add_argument("--minPeaks", help="Index only if above minimum number of pe
 parser.add_argument("--maxPeaks", help="Index only if below maximum number of peaks",default=2048, type=int)
 parser.add_argument("--minRes", help="Index only if above minimum resolution",default=0, type=int)
 parser.add_argument("--localCalib", help="Use local calib directory. A calib directory must exist in your current working directory.", action='store_true')
+parser.add_argument("--veto",help="skip peak finding on events with few lit pixels, see eventVeto",default=0, type=int)
+parser.add_argument("--vetoThreshold",help="ADU above pedestal of a lit pixel",default=100, type=float)
+parser.add_argument("--vetoMinLit",help="minimum number of lit pixels for peak finding",default=20, type=int)
+parser.add_argument("--vetoStep",help="only every vetoStep-th row and column is used by the veto",default=4, type=int)
+parser.add_argument("--vetoAudit",help="fraction of vetoed events processed anyway to estimate the fraction of hits that are vetoed",default=0.01, type=float)
 parser.add_argument("--profile", help="Turn on profiling. Saves timing information for calibration, peak finding, and saving to hdf5", action='store_true')
 parser.add_argument("--cxiVersion", help="cxi version",default=140, type=int)
+parser.add_argument("--batchTime", help="target processing time in seconds of each batch of events handed to a rank",default=1.0, type=float)
+parser.add_argument("--maxBatchSize", help="maximum number of events handed to a rank at a time",default=100, type=int)
+parser.add_argument("--writeBufferSize", help="number of events buffered in memory before writing the peak tables",default=256, type=int)
+parser.add_argument("--flushInterval", help="maximum time in seconds buffered results are kept before writing",default=10., type=float)
+parser.add_argument("--coalesce", help="number of events packed into one message to the master, 0 sends every event on its own",default=0, type=int)
+parser.add_argument("--coalesceBufferSize", help="size in bytes of the buffers of coalesced messages, larger events are sent on their own",default=1<<20, type=int)
+parser.add_argument("--coalesceMemory", help="maximum size in bytes of the receive buffers of coalesced messages on rank 0, lowers the buffer size for many ranks",default=256<<20, type=int)
+parser.add_argument("--compressFrames", help="workers store hit frames as float32 and compress them, the master writes the compressed chunks as they are", action='store_true')
+parser.add_argument("--sharded", help="each worker writes its results to a shard file next to the cxi file, which holds virtual datasets over the shards", action='store_true')
+parser.add_argument("--epicsPeriod", help="machine time in seconds after which epics values are read again within a calib cycle, 0 reads them once per calib cycle",default=0., type=float)
+parser.add_argument("--powderMinPeaks", help="minimum number of peaks of a hit in the powder of hits, -1 uses minPeaks, maxPeaks and minRes",default=15, type=int)
+parser.add_argument("--powderFloat32", help="accumulate the powders in float32 instead of float64, halves their memory at the cost of precision of the sigma powders", action='store_true')
 args = parser.parse_args()
 
-def getNoe(args):
-    runStr = "%04d" % args.run
-    ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
-    run = ds.runs().next()
-    times = run.times()
+def getNoe(args, context=None):
+    if context is not None:
+        times = context.times
+    else:
+        runStr = "%04d" % args.run
+        ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
+        run = ds.runs().next()
+        times = run.times()
     # check if the user requested specific number of events
     if args.noe == -1:
         numJobs = len(times)
@@ -87,9 +113,12 @@ def getNoe(args):
 
 if args.localCalib: psana.setOption('psana.calib-dir','./calib')
 
+# DataSource, run and detector shared by everything on this rank
+context = psanaWhisperer.RunContext(args.exp, args.run, args.det)
+
 if rank == 0:
     # Set up psana
-    ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib)
+    ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, context=context)
     ps.setupExperiment()
     img = ps.getCheetahImg()
     (dim0, dim1) = img.shape
@@ -98,7 +127,7 @@ if rank == 0:
     runStr = "%04d" % args.run
     fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
     # Get number of events to process
-    numJobs = getNoe(args)
+    numJobs = getNoe(args, context)
 
     # Create hdf5 and save psana input
     myHdf5 = h5py.File(fname, 'w')
@@ -231,6 +260,8 @@ if rank == 0:
     myHdf5.create_dataset("/entry_1/result_1/peakYPosRawAll", (numJobs,2048), dtype=float, chunks=(1,2048))
     myHdf5.create_dataset("/entry_1/result_1/peakTotalIntensityAll", (numJobs,2048), dtype=float, chunks=(1,2048))
     myHdf5.create_dataset("/entry_1/result_1/maxResAll", data=np.ones(numJobs,)*-1, dtype=int)
+    if args.veto:
+        myHdf5.create_dataset("/entry_1/result_1/vetoAll", data=np.ones(numJobs,)*-1, dtype=int)
     myHdf5.flush()
 
     if args.profile:
@@ -279,6 +310,24 @@ if rank == 0:
                                              dtype=int)
     ds_maxRes.attrs["axes"] = "experiment_identifier:peaks"
 
+    ds_peakRadius = myHdf5.create_dataset("/entry_1/result_1/peakRadius",(0,2048),
+                                             maxshape=(None,2048),
+                                             chunks=(1, 2048),
+                                             compression='gzip',
+                                             compression_opts=1,
+                                             dtype=float)
+    ds_peakRadius.attrs["axes"] = "experiment_identifier:peaks"
+    ds_peakRadius.attrs["unit"] = "pixel"
+
+    ds_peakResolution = myHdf5.create_dataset("/entry_1/result_1/peakResolution",(0,2048),
+                                             maxshape=(None,2048),
+                                             chunks=(1, 2048),
+                                             compression='gzip',
+                                             compression_opts=1,
+                                             dtype=float)
+    ds_peakResolution.attrs["axes"] = "experiment_identifier:peaks"
+    ds_peakResolution.attrs["unit"] = "Angstrom"
+
     myHdf5.flush()
 
     entry_1.create_dataset("start_time",data=ps.getStartTime())
@@ -316,7 +365,7 @@ if rank == 0:
                                 maxshape=(None, dim0, dim1),
                                 compression='gzip',
                                 compression_opts=1,
-                                dtype=float)
+                                dtype=np.float32 if args.compressFrames else float)
     ds_data_1.attrs["axes"] = "experiment_identifier"
 
     data_1 = entry_1.create_group("data_1")
@@ -353,13 +402,26 @@ if rank == 0:
     detector_1.create_dataset("description",data=args.det)
     myHdf5.flush()
 
+    # workers create the same datasets in their shards
+    schema = None
+    if args.sharded:
+        schema = getSchema(myHdf5, getEventDatasets(args) + hitDatasets + [frameDataset])
+
     myHdf5.close()
+else:
+    schema = None
+
+if args.sharded:
+    schema = comm.bcast(schema, root=0)
+
+# workers merge their powders among themselves at the end of the run
+workerComm = comm.Split(0 if rank > 0 else MPI.UNDEFINED, rank)
 
 comm.Barrier()
 
 if rank==0:
-    runmaster(args,numClients)
+    runmaster(args,numClients,context)
 else:
-    runclient(args)
+    runclient(args, schema, context, workerComm)
 
 MPI.Finalize()
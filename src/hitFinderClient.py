@@ -9,6 +9,22 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+def getThresholds(args):
+    """litPixelThreshold followed by the other thresholds of --litPixelThresholds"""
+    thresholds = [args.litPixelThreshold]
+    for t in args.litPixelThresholds.split(','):
+        if t.strip() and float(t) not in thresholds:
+            thresholds.append(float(t))
+    return thresholds
+
+def getRois(args):
+    return [np.load(fname.strip()) for fname in args.roiMasks.split(',') if fname.strip()]
+
+def hasLitPixelCounts(args):
+    """True if the lit pixel counts of several thresholds or ROIs are saved in litPixelsAll"""
+    numRois = len([fname for fname in args.roiMasks.split(',') if fname.strip()])
+    return args.algorithm == 2 and (len(getThresholds(args)) > 1 or numRois > 0)
+
 def runclient(args):
     ds = psana.DataSource("exp="+args.exp+":run="+str(args.run)+':idx')
     run = ds.runs().next()
@@ -16,6 +32,7 @@ def runclient(args):
     times = run.times()
     d = psana.Detector(args.detectorName)
     d.do_reshape_2d_to_3d(flag=True)
+    sendLitPixels = hasLitPixelCounts(args)
 
     for nevent in np.arange(len(times)):
         if nevent == args.noe : break
@@ -34,6 +51,9 @@ def runclient(args):
                                            evt,
                                            d,
                                            args.pruneInterval,
+                                           bufferLength=args.bufferLength,
+                                           nSigma=args.nSigma,
+                                           chiSquaredThreshold=args.chiSquaredThreshold,
                                            streakMask_on=args.streakMask_on,
                                            streakMask_sigma=args.streakMask_sigma,
                                            streakMask_width=args.streakMask_width,
@@ -45,6 +65,9 @@ def runclient(args):
                                            psanaMask_central=args.psanaMask_central,
                                            psanaMask_unbond=args.psanaMask_unbond,
                                            psanaMask_unbondnrs=args.psanaMask_unbondnrs)
+                # start from a background made of the next events of this rank, not the one being scored
+                myEvents = [i for i in np.arange(nevent+1, len(times)) if i%(size-1) == rank-1][:args.bufferLength]
+                d.hitFinder.digestInitialEvents(d.calib(run.event(times[i])) for i in myEvents)
             elif args.algorithm == 2: # lit pixels
                 d.hitFinder = hf.HitFinder(env.experiment(),
                                            evt.run(),
@@ -52,6 +75,8 @@ def runclient(args):
                                            evt,
                                            d,
                                            args.litPixelThreshold,
+                                           thresholds=getThresholds(args),
+                                           rois=getRois(args),
                                            streakMask_on=args.streakMask_on,
                                            streakMask_sigma=args.streakMask_sigma,
                                            streakMask_width=args.streakMask_width,
@@ -67,6 +92,10 @@ def runclient(args):
         md=mpidata()
         md.small.eventNum = nevent
         md.small.nPixels = d.hitFinder.nPixels
+        if args.algorithm == 1:
+            md.small.chiSquared = d.hitFinder.chiSquared
+        if sendLitPixels: # nPixels alone is sent for a single threshold without ROIs
+            md.addarray('litPixels', d.hitFinder.litPixels)
         md.small.powder = 0
         md.send() # send mpi data object to master when desired
 
@@ -3,12 +3,18 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+import os, time
 import h5py, json
 from mpidata import mpidata
+from cxiWriter import EventRowBuffer
 import psana
 
 def writeStatus(fname,d):
-    json.dump(d, open(fname, 'w'))
+    """Replace the status file at once, readers never see a partly written file"""
+    tmpName = fname + ".tmp"
+    with open(tmpName, 'w') as f:
+        json.dump(d, f)
+    os.rename(tmpName, fname)
 
 def getNoe(args):
     runStr = "%04d" % args.run
@@ -43,6 +49,14 @@ def runmaster(args,nClients):
     writeStatus(statusFname, d)
 
     myHdf5 = h5py.File(fname, 'r+')
+    hasLitPixels = grpName+"/litPixelsAll" in myHdf5
+    hasChiSquared = grpName+"/chiSquaredAll" in myHdf5
+    # per event results are buffered and written in blocks of consecutive events
+    eventDatasets = [grpName+dset_nHits]
+    if hasChiSquared: eventDatasets.append(grpName+"/chiSquaredAll")
+    if hasLitPixels: eventDatasets.append(grpName+"/litPixelsAll")
+    eventBuffer = EventRowBuffer(myHdf5, eventDatasets, maxRows=args.writeBufferSize, flushInterval=args.flushInterval)
+    lastStatus = time.time()
     while nClients > 0:
         # Remove client if the run ended
         md = mpidata()
@@ -61,13 +75,22 @@ def runmaster(args,nClients):
                 nPixels = md.small.nPixels
             except:
                 continue
-            myHdf5[grpName+dset_nHits][md.small.eventNum] = nPixels
-            myHdf5.flush()
+            row = {grpName+dset_nHits: nPixels}
+            if hasChiSquared and hasattr(md.small, 'chiSquared'):
+                row[grpName+"/chiSquaredAll"] = md.small.chiSquared
+            if hasLitPixels and hasattr(md, 'litPixels'):
+                row[grpName+"/litPixelsAll"] = md.litPixels
+            eventBuffer.append(md.small.eventNum, row)
             numProcessed += 1
-            # Update status
-            fracDone = numProcessed * 100. / numEvents
-            d = {"fracDone": fracDone}
-            writeStatus(statusFname, d)
+            # Update status every statusInterval seconds
+            if time.time() - lastStatus >= args.statusInterval:
+                fracDone = numProcessed * 100. / numEvents
+                d = {"fracDone": fracDone}
+                writeStatus(statusFname, d)
+                lastStatus = time.time()
+    eventBuffer.flush()
+    d = {"fracDone": numProcessed * 100. / numEvents}
+    writeStatus(statusFname, d)
 
     if '/status/findHits' in myHdf5:
         del myHdf5['/status/findHits']
@@ -9,6 +9,7 @@ import argparse
 import time
 import os
 import socket
+from cxiWriter import EventRowBuffer
 
 parser = argparse.ArgumentParser()
 parser.add_argument("exprun", help="psana experiment/run string (e.g. exp=xppd7114:run=43)", type=str)
@@ -16,10 +17,12 @@ parser.add_argument("-t","--tag",help="append tag to end of filename",default=No
 parser.add_argument("-d","--detectorName",help="psana detector alias, (e.g. pnccdBack, DsaCsPad)", type=str)
 parser.add_argument("-o","--outdir",help="output directory",default=0, type=str)
 parser.add_argument("-n","--noe",help="number of events, all events=0",default=0, type=int)
-parser.add_argument("-m","--mask",help="full path to binary mask numpy ndarray (psana shape)",default=None, type=str)
-parser.add_argument("-l","--litPixelThreshold",help="number of ADUs to be considered a lit pixel",default=100, type=float)
+parser.add_argument("-m","--mask",help="full path to binary mask numpy ndarray (psana shape), comma separated per detector (e.g. front.npy,back.npy or ,back.npy)",default=None, type=str)
+parser.add_argument("-l","--litPixelThreshold",help="number of ADUs to be considered a lit pixel, comma separated per detector (e.g. 100,50)",default="100", type=str)
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
+parser.add_argument("--writeBufferSize", help="number of events buffered in memory before writing the hit metrics",default=256, type=int)
+parser.add_argument("--flushInterval", help="maximum time in seconds buffered results are kept before writing",default=10., type=float)
 args = parser.parse_args()
 assert os.path.isdir(args.outdir)
 
@@ -87,6 +90,20 @@ for det in myDetList:
     det.do_reshape_2d_to_3d(flag=True)
 numDet = len(aliasList)
 
+def perDetector(option, convert):
+    """Per detector values of a comma separated option, a single value applies to all detectors"""
+    values = [convert(val) for val in option.split(",")]
+    if len(values) == 1:
+        values = values * numDet
+    assert len(values) == numDet, 'Require one value per detector: '+option
+    return values
+
+litPixelThresholds = perDetector(args.litPixelThreshold, float)
+# a single mask is the mask of the first detector
+maskPaths = [path or None for path in (args.mask or "").split(",")]
+maskPaths += [None] * (numDet - len(maskPaths))
+assert len(maskPaths) == numDet, 'Require at most one mask per detector: '+args.mask
+
 # def getGains(evt):
 #     for d in myDetList:
 #         d.gains = d.gain(evt) # CHUCK: gain is not deployed for amo87215, returns 1
@@ -95,7 +112,7 @@ numDet = len(aliasList)
 #             d.gains *= hybridGain
 
 def getMasks(evt):
-    for d in myDetList:
+    for d, maskPath in zip(myDetList, maskPaths):
         d.spiMask = np.copy(d.mask(evt, calib=False, edges=True, central=True, unbond=True, unbondnbrs=True))  # calib is user-defined
         if d.spiMask.size==2296960:  # number of pixels of CSPAD
             d.spiMask = d.spiMask.reshape((32,185,388))
@@ -103,8 +120,8 @@ def getMasks(evt):
             d.spiMask = d.spiMask.reshape((4,512,512))
         if d.spiMask is None:
             d.spiMask = np.ones_like(d.spiMask.shape)
-        if args.mask and d == myDetList[0]:
-            userMask = np.load(args.mask)
+        if maskPath:
+            userMask = np.load(maskPath)
             if d.spiMask.shape == userMask.shape: # unassembled mask
                 d.spiMask *= userMask
             elif d.spiMask.size == userMask.shape: # assembled mask
@@ -120,34 +137,6 @@ def getEventID(evt):
     fiducials = evtid.fiducials()
     return seconds, nanoseconds, fiducials
 
-def nunchakuAlgorithm(stickLength=15):
-    # Generate output filename
-    if args.tag is None:
-        outname = os.path.join(args.outdir, env.experiment()+'_'+str(run.run())+'.h5')
-    else:
-        outname = os.path.join(args.outdir, env.experiment() + '_' + str(run.run()) + '_' + args.tag + '.h5')
-    # Clean up hdf5 structure if it exists
-    f = h5py.File(outname, 'r+')
-    t             = f[grpName+'/eventTime'].value
-    fid           = f[grpName+'/fiducials'].value
-    hitMetric     = f[grpName+'/hitMetric'].value
-    timeOrder   = t.argsort()
-    hitMetric = hitMetric[timeOrder]
-    numEvents = len(hitMetric)
-    
-    hitMetric_ds    = f.require_dataset(grpName+"/hitMetric", (numEvents,), dtype='float32')
-    hitMetric_ds[...] = hitMetric
-    event_ds    = f.create_dataset(grpName+"/event", (numEvents,), dtype='uint32')
-    event_ds[...] = np.arange(numEvents)
-
-    # Reorder other dataset in time
-    evttime_ds = f.require_dataset(grpName+"/eventTime", (numEvents,),dtype='uint64')
-    fids_ds    = f.require_dataset(grpName+"/fiducials", (numEvents,), dtype='uint32')
-    evttime_ds[...] = t[timeOrder]
-    fids_ds[...] = fid[timeOrder]
-    f.flush()
-    f.close()
-
 class bigMsg:
     """Message holding the events message and raw image"""
     def __init__(self):
@@ -200,16 +189,26 @@ def getNumEventsToProc(run,noe):
         numEventsToProc = noe
     return numEventsToProc
 
+def getTimeOrder(times):
+    """Returns the position of every event when the events are sorted in time"""
+    eventTime = np.array([(t.seconds() << 32) | t.nanoseconds() for t in times], dtype=np.uint64)
+    slots = np.zeros(len(times), dtype=np.int64)
+    slots[eventTime.argsort(kind='mergesort')] = np.arange(len(times))
+    return slots
+
 def getMyUnfairShare(run,numslaves,rank,numOfEventsToProc=0):
-    """Returns number of events assigned to the slave calling this function"""
+    """Returns the events assigned to the slave calling this function and their
+       global event indices, the rows of the output sorted in time
+    """
     times = run.times()
     assert(len(times) > numOfEventsToProc)
     numEvents = getNumEventsToProc(run,numOfEventsToProc)
     jobChunks = np.array_split(np.arange(numEvents),numslaves)
     myChunk = jobChunks[rank-1]
     myJobs = times[myChunk[0]:myChunk[-1]+1]
+    myEventNums = getTimeOrder(times[:numEvents])[myChunk]
     print("number of assigned events: ", len(myJobs))
-    return myJobs
+    return myJobs, myEventNums
 
 class slave_class(object):
     """
@@ -224,7 +223,7 @@ class slave_class(object):
         self.numDet         = numDet
         self.rank           = rank
         self.noe            = noe
-        self.myJobs         = getMyUnfairShare(self.run, numslaves, rank, noe)
+        self.myJobs, self.myEventNums = getMyUnfairShare(self.run, numslaves, rank, noe)
         self.tstart         = time.time()
         self.totalJobs      = len(self.myJobs)
         self.myMask         = [None for nd in range(numDet)]
@@ -254,16 +253,18 @@ class slave_class(object):
             # Get event identifiers
             seconds, nanoseconds, fiducials = getEventID(evt)
 
-            # Hit find on the first detector
-            calib = myDetList[0].calib(evt)
-            try:
-                calib *= self.myMask[0] # myMask masks away high and low variance pixels (includes spiMask)
-                hitMetric = np.where(calib>args.litPixelThreshold)[0].shape[0]
-            except:
-                hitMetric = 0
+            # Hit find on every detector of the event
+            hitMetrics = []
+            for i in range(self.numDet):
+                calib = myDetList[i].calib(evt)
+                try:
+                    calib *= self.myMask[i] # myMask masks away high and low variance pixels (includes spiMask)
+                    hitMetrics.append(np.count_nonzero(calib>litPixelThresholds[i]))
+                except:
+                    hitMetrics.append(0)
 
             # Sends smallMsg component to BigMsg
-            self.myMsg.events = (seconds, nanoseconds, fiducials, hitMetric)
+            self.myMsg.events = (seconds, nanoseconds, fiducials, hitMetrics, self.myEventNums[nevent])
 
             # Sends to BigMsg a list of detector arrays if it's a hit
             # otherwise, sends an empty list
@@ -291,10 +292,13 @@ def master():
         del f[grpName]
     grp = f.create_group(grpName)
     # Initialize event identifiers
-    evttime_ds = grp.create_dataset("eventTime", (numEventsToProc,),dtype='uint64')
-    fids_ds    = grp.create_dataset("fiducials", (numEventsToProc,), dtype='uint32')
-    # Initialize hit metric
+    grp.create_dataset("eventTime", (numEventsToProc,),dtype='uint64')
+    grp.create_dataset("fiducials", (numEventsToProc,), dtype='uint32')
+    # Initialize hit metric, hitMetric is the metric of the first detector
     hitMetric_ds    = grp.create_dataset("hitMetric", (numEventsToProc,), dtype='float32')
+    detMetric_ds    = [grp.create_dataset(alias+"/hitMetric", (numEventsToProc,), dtype='float32') for alias in aliasList]
+    event_ds    = grp.create_dataset("event", (numEventsToProc,), dtype='uint32')
+    event_ds[...] = np.arange(numEventsToProc)
     f.flush()
 
     # Loop over all detectors and initialize/save fields
@@ -324,6 +328,12 @@ def master():
             thisCoordsZ = grp.create_dataset(aliasList[i]+"/coordsZ", np.shape(coordsZ), dtype='float32')
             thisCoordsZ[...] = coordsZ
 
+    # Results arrive tagged with their event index, the row of the event sorted in time,
+    # and are buffered and written in blocks of consecutive events
+    eventDatasets = [grpName+"/eventTime", grpName+"/fiducials", grpName+"/hitMetric"] + \
+                    [grpName+"/"+alias+"/hitMetric" for alias in aliasList]
+    eventBuffer = EventRowBuffer(f, eventDatasets, maxRows=args.writeBufferSize, flushInterval=args.flushInterval)
+
     # Receive results from slaves
     status = MPI.Status()
     nevts = 0
@@ -338,13 +348,17 @@ def master():
             seconds = smallMsg.events[0]
             nanoseconds = smallMsg.events[1]
             fiducials = smallMsg.events[2]
-            hitMetric = smallMsg.events[3]
-
-            evttime_ds[nevts] = (seconds << 32) | nanoseconds
-            fids_ds[nevts] = fiducials
-            hitMetric_ds[nevts] = hitMetric
-            f.flush()
+            hitMetrics = smallMsg.events[3]
+            eventNum = smallMsg.events[4]
+
+            row = {grpName+"/eventTime": (seconds << 32) | nanoseconds,
+                   grpName+"/fiducials": fiducials,
+                   grpName+"/hitMetric": hitMetrics[0]}
+            for i in range(numDet):
+                row[grpName+"/"+aliasList[i]+"/hitMetric"] = hitMetrics[i]
+            eventBuffer.append(eventNum, row)
             nevts+=1
+    eventBuffer.flush()
 
     # Save attributes
     hitMetric_ds.attrs['numEvents'] = nevts
@@ -354,6 +368,11 @@ def master():
     hitMetric_ds.attrs['detectorName'] = args.detectorName
     hitMetric_ds.attrs['psanaVersion'] = psana_version
     hitMetric_ds.attrs['svnVersion'] = svn_version
+    hitMetric_ds.attrs['litPixelThreshold'] = litPixelThresholds[0]
+    for i in range(numDet):
+        detMetric_ds[i].attrs['numEvents'] = nevts
+        detMetric_ds[i].attrs['detectorName'] = aliasList[i]
+        detMetric_ds[i].attrs['litPixelThreshold'] = litPixelThresholds[i]
     f.flush()
     f.close()
 
@@ -369,7 +388,4 @@ else:
     print('Starting rank: ',rank,'hostname: ',socket.gethostname())
     curr_slave.process_run()
 
-if rank==0:
-    nunchakuAlgorithm() # reorder in time
-
 MPI.Finalize()
@@ -1,4 +1,5 @@
 import numpy as np
+import cPickle
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
@@ -14,6 +15,7 @@ class small(object):
     def __init__(self):
         self.arrayinfolist = []
         self.endrun = False
+        self.workRequest = False
     def addarray(self,name,array):
         self.arrayinfolist.append(arrayinfo(name,array))
 
@@ -23,16 +25,22 @@ class mpidata(object):
         self.small=small()
         self.arraylist = []
 
-    def endrun(self):
+    def endrun(self,coalescer=None):
         self.small.endrun = True
-        comm.send(self.small,dest=0,tag=rank)
+        if coalescer is not None:
+            coalescer.add(self)
+        else:
+            comm.send(self.small,dest=0,tag=rank)
 
     def addarray(self,name,array):
         self.arraylist.append(array)
         self.small.addarray(name,array)
 
-    def send(self):
+    def send(self,coalescer=None):
         assert rank!=0
+        if coalescer is not None:
+            coalescer.add(self)
+            return
         comm.send(self.small,dest=0,tag=rank)
         for arr in self.arraylist:
             assert arr.flags['C_CONTIGUOUS']
@@ -43,9 +51,183 @@ class mpidata(object):
         status=MPI.Status()       
         self.small=comm.recv(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
         recvRank = status.Get_source()
+        self.source = recvRank
         if not self.small.endrun:
             for arrinfo in self.small.arrayinfolist:
                 if not hasattr(self,arrinfo.name) or arr.shape!=arrinfo.shape or arr.dtype!=arrinfo.dtype:
                     setattr(self,arrinfo.name,np.empty(arrinfo.shape,dtype=arrinfo.dtype))
                 arr = getattr(self,arrinfo.name)
                 comm.Recv(arr,source=recvRank,tag=MPI.ANY_TAG)
+
+# Coalesced transport: a worker packs the messages of many events into one
+# uint8 buffer laid out as
+#   [int64 header offset][int64 header length][arrays ...][pickled header]
+# where the header is the list of small objects and every arrayinfo carries the
+# offset of its array. Rank 0 pre-posts receives into reusable buffers and hands
+# out the arrays as views of those buffers.
+packedTag = 1
+oversizeTag = 2
+alignment = 16
+
+def _aligned(n):
+    return (n + alignment - 1) // alignment * alignment
+
+def coalesceBufferSize(bufferSize, numWorkers, maxMemory=256<<20, numBuffers=2, minSize=1<<16):
+    """Buffer size used by the workers and rank 0, at most bufferSize and small enough
+       for the receive buffers of all workers to fit in maxMemory bytes
+    """
+    share = maxMemory // max(numWorkers * numBuffers, 1)
+    return int(max(min(bufferSize, share), minSize))
+
+class Coalescer(object):
+    """Worker side of the coalesced transport.
+
+       Events are copied into a send buffer of bufferSize bytes which is sent
+       with one MPI call once maxEvents events are pending or the buffer is
+       full. Work requests and endrun are sent right away, together with the
+       events before them. An event that does not fit in an empty buffer is
+       announced in a packed message and sent on its own.
+    """
+    def __init__(self, maxEvents=32, bufferSize=1<<20):
+        self.maxEvents = maxEvents
+        self.bufferSize = bufferSize
+        self.buf = np.empty(bufferSize, dtype=np.uint8)
+        self.reset()
+
+    def reset(self):
+        self.header = []
+        self.offset = 16
+
+    def eventSize(self, md):
+        return sum([_aligned(arr.nbytes) for arr in md.arraylist])
+
+    def pack(self, md, buf, offset):
+        for arr, arrinfo in zip(md.arraylist, md.small.arrayinfolist):
+            arr = np.ascontiguousarray(arr)
+            buf[offset:offset+arr.nbytes] = arr.reshape(-1).view(np.uint8)
+            arrinfo.offset = offset
+            offset = _aligned(offset + arr.nbytes)
+        return offset
+
+    def finish(self, buf, header, offset):
+        """Append the header, returns the number of bytes to send"""
+        hdr = np.frombuffer(cPickle.dumps(header, 2), dtype=np.uint8)
+        buf[0:16].view(np.int64)[:] = (offset, hdr.size)
+        buf[offset:offset+hdr.size] = hdr
+        return offset + hdr.size
+
+    def add(self, md):
+        nbytes = self.eventSize(md)
+        # reserve some room for the header, a pickled small is well under 4 kB
+        if self.offset + nbytes + 4096 * (len(self.header) + 2) > self.bufferSize:
+            self.flush()
+        if 16 + nbytes + 4096 * 2 > self.bufferSize:
+            self.sendOversize(md, nbytes)
+        else:
+            self.offset = self.pack(md, self.buf, self.offset)
+            self.header.append(md.small)
+        if len(self.header) >= self.maxEvents or md.small.workRequest or md.small.endrun:
+            self.flush()
+
+    def sendOversize(self, md, nbytes):
+        big = np.empty(16 + nbytes + 4096, dtype=np.uint8)
+        n = self.finish(big, [md.small], self.pack(md, big, 16))
+        notice = small()
+        notice.oversize = n
+        self.header.append(notice)
+        self.flush()
+        comm.Send([big[:n], MPI.BYTE], dest=0, tag=oversizeTag)
+
+    def flush(self):
+        if not self.header: return
+        n = self.finish(self.buf, self.header, self.offset)
+        comm.Send([self.buf[:n], MPI.BYTE], dest=0, tag=packedTag)
+        self.reset()
+
+class CoalescedReceiver(object):
+    """Rank 0 side of the coalesced transport.
+
+       numBuffers receives of bufferSize bytes are kept posted for every source,
+       see coalesceBufferSize for a size that bounds their memory.
+       recv() returns one mpidata at a time with its arrays being views of the
+       receive buffer, so they are only valid until the next call to recv().
+       Copy arrays that need to live longer.
+    """
+    def __init__(self, sources, bufferSize=1<<20, numBuffers=2):
+        self.bufferSize = bufferSize
+        self.slots = [] # (source, buffer), indexed like self.requests
+        self.requests = []
+        self.seq = []
+        self.numPosted = 0
+        self.done = set()
+        for src in sources:
+            for i in range(numBuffers):
+                self.slots.append((src, np.empty(bufferSize, dtype=np.uint8)))
+                self.requests.append(MPI.REQUEST_NULL)
+                self.seq.append(0)
+                self.post(len(self.slots) - 1)
+        self.pending = [] # (mpidata, slot to repost once it has been handed out or None)
+        self.release = None
+
+    def post(self, i):
+        src, buf = self.slots[i]
+        if src in self.done: return
+        self.requests[i] = comm.Irecv([buf, MPI.BYTE], source=src, tag=packedTag)
+        self.numPosted += 1
+        self.seq[i] = self.numPosted
+
+    def unpack(self, buf, src):
+        offset, length = buf[0:16].view(np.int64)
+        header = cPickle.loads(buf[offset:offset+length].tobytes())
+        mds = []
+        for s in header:
+            if getattr(s, 'oversize', 0):
+                big = np.empty(s.oversize, dtype=np.uint8)
+                comm.Recv([big, MPI.BYTE], source=src, tag=oversizeTag)
+                mds += self.unpack(big, src)
+                continue
+            md = mpidata()
+            md.small = s
+            md.source = src
+            for arrinfo in s.arrayinfolist:
+                nbytes = int(np.prod(arrinfo.shape)) * np.dtype(arrinfo.dtype).itemsize
+                arr = buf[arrinfo.offset:arrinfo.offset+nbytes].view(arrinfo.dtype).reshape(arrinfo.shape)
+                setattr(md, arrinfo.name, arr)
+            mds.append(md)
+        return mds
+
+    def cancel(self, src):
+        """Cancel the receives still posted for a source that ended its run.
+           Receives that completed before they could be cancelled are unpacked.
+        """
+        self.done.add(src)
+        status = MPI.Status()
+        posted = [i for i, (s, buf) in enumerate(self.slots) if s == src and self.requests[i] != MPI.REQUEST_NULL]
+        for i in sorted(posted, key=lambda j: self.seq[j]):
+            self.requests[i].Cancel()
+            self.requests[i].Wait(status)
+            self.requests[i] = MPI.REQUEST_NULL
+            if not status.Is_cancelled():
+                # not reposted since the source is done, its arrays stay valid
+                self.pending += [(md, None) for md in self.unpack(self.slots[i][1], src)]
+
+    def recv(self):
+        # the caller is done with the previous message, its buffer can take new data
+        if self.release is not None:
+            self.post(self.release)
+            self.release = None
+        while not self.pending:
+            completed = MPI.Request.Waitsome(self.requests)
+            # receives from one source complete in the order they were posted
+            for i in sorted(completed, key=lambda j: self.seq[j]):
+                self.requests[i] = MPI.REQUEST_NULL
+                src, buf = self.slots[i]
+                mds = self.unpack(buf, src)
+                for md in mds:
+                    self.pending.append((md, None))
+                # repost once the last message of this buffer has been handed out
+                self.pending[-1] = (self.pending[-1][0], i)
+        md, self.release = self.pending.pop(0)
+        if md.small.endrun:
+            self.cancel(md.source)
+        return md
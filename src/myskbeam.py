@@ -1,6 +1,7 @@
 from scipy import signal as sg
 import numpy as np
 from skimage.measure import label
+from scipy import ndimage
 import time
 
 def getStreakMask(det,evt):
@@ -49,11 +50,27 @@ def getStreakMask(det,evt):
     return fullMask
 
 class StreakMask:
-    def __init__(self, det, evt, width=300, sigma=1):
+    """Masks streaks that cross the edges of the panels in a width x width region
+       around the beam centre.
+
+       The assembled crop is gathered straight from the unassembled calib array
+       through a precomputed index table, so the full image is never assembled.
+       Connected components touching a panel edge are found with one bincount
+       over the labels at the edge pixels.
+    """
+    def __init__(self, det, evt, width=300, sigma=1, tolerance=0., maxAge=1):
         self.det = det
         self.evt = evt
         self.width = width
         self.sigma = sigma
+        # the mask is reused until the signature drifts by more than tolerance
+        # or it is maxAge events old, maxAge=1 recomputes it for every event
+        self.tolerance = tolerance
+        self.maxAge = maxAge
+        self.lastMask = None
+        self.lastSignature = None
+        self.age = 0
+        self.numComputed = 0
         calib = det.calib(evt)
         self.calibShape = calib.shape
         self.calibSize = calib.size
@@ -69,59 +86,92 @@ class StreakMask:
         (self.ix,self.iy) = det.point_indexes(evt)
         if self.ix is not None:
             self.halfWidth = int(width/2) # pixels
-            self.imgEdges = imgEdges[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth]
+            crop = (slice(self.ix-self.halfWidth,self.ix+self.halfWidth), slice(self.iy-self.halfWidth,self.iy+self.halfWidth))
+            self.imgEdges = imgEdges[crop]
             self.myInd = np.where(self.imgEdges==1)
+            self.isEdge = self.imgEdges==1
             # Pixel indices
             a=np.arange(calib.size)+1
             a=a.reshape(calib.shape)
             self.assem=det.image(evt,a)
+            # index in the flat calib array of every pixel of the crop, -1 where there is no pixel
+            self.cropInd = np.rint(self.assem[crop]).astype(np.int64) - 1
+            self.hasPixel = self.cropInd >= 0
+            self.cropInd[~self.hasPixel] = 0
+            self.imgCrop = np.zeros(self.cropInd.shape)
+            self.rowSum = np.zeros(self.cropInd.shape)
+            # the signature is the edge pixels of the crop summed in bins of 16
+            self.edgeInd = self.cropInd[self.isEdge & self.hasPixel]
+            self.signatureBins = np.arange(0, self.edgeInd.size, 16)
+            self.imgBlur = np.zeros(self.cropInd.shape)
         else:
             self.assem = None
 
+    def getSignature(self, calib):
+        """Cheap summary of the streak region, normalized so that shot to shot
+           intensity changes alone do not count as drift
+        """
+        if self.edgeInd.size == 0: return np.zeros(0)
+        signature = np.add.reduceat(np.take(calib.ravel(), self.edgeInd), self.signatureBins)
+        total = np.abs(signature).sum()
+        if total > 0: signature /= total
+        return signature
+
     def getStreakMaskCalib(self, evt, calib=None):
         if self.assem is not None:
 
-            if calib is not None:
-                img = self.det.image(evt, calib)
-            else:
-                img = self.det.image(evt)
-
-            # Crop centre of image
-            imgCrop = img[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth]
+            if calib is None:
+                calib = self.det.calib(evt)
 
-            # Blur image
-            imgBlur=sg.convolve(imgCrop,np.ones((2,2)),mode='same')
-            mean = imgBlur[imgBlur>0].mean()
-            std = imgBlur[imgBlur>0].std()
+            # Reuse the last mask while the streak region looks the same
+            if self.maxAge > 1:
+                signature = self.getSignature(calib)
+                if self.lastMask is not None and self.age < self.maxAge and \
+                   np.abs(signature - self.lastSignature).sum() <= self.tolerance:
+                    self.age += 1
+                    return self.lastMask
+                self.lastSignature = signature
+            self.age = 1
+            self.numComputed += 1
 
-            # Mask out pixels above 1 sigma
+            # Crop centre of image
+            imgCrop = self.imgCrop
+            np.take(calib.ravel(), self.cropInd, out=imgCrop)
+            imgCrop[~self.hasPixel] = 0
+
+            # Blur image, same as sg.convolve(imgCrop,np.ones((2,2)),mode='same')
+            rowSum = self.rowSum
+            rowSum[...] = imgCrop
+            rowSum[1:] += imgCrop[:-1]
+            imgBlur = self.imgBlur
+            imgBlur[...] = rowSum
+            imgBlur[:,1:] += rowSum[:,:-1]
+            positive = imgBlur[imgBlur>0]
+            mean = positive.mean()
+            std = positive.std()
+
+            # Mask out pixels above sigma
             mask = imgBlur > mean+self.sigma*std
-            mask = mask.astype(int)
-            signalOnEdge = mask * self.imgEdges
-            mySigInd = np.where(signalOnEdge==1)
-            mask[self.myInd[0].ravel(),self.myInd[1].ravel()] = 1
-
-            # Connected components
-            myLabel = label(mask, neighbors=4, connectivity=1, background=0)
-            # All pixels connected to edge pixels is masked out
-            myMask = np.ones_like(mask)
-            myParts = np.unique(myLabel[self.myInd])
-            for i in myParts:
-                myMask[np.where(myLabel == i)] = 0
+            signalOnEdge = mask & self.isEdge
+            mask |= self.isEdge
+
+            # Connected components, 4-connected
+            myLabel, numLabels = ndimage.label(mask)
+            # All pixels connected to edge pixels are masked out
+            edgeLabel = np.bincount(myLabel[self.isEdge], minlength=numLabels+1) > 0
+            edgeLabel[0] = False
+            masked = edgeLabel[myLabel]
 
             # Delete edges
-            myMask[self.myInd]=1
-            myMask[mySigInd]=0
+            masked[self.isEdge] = False
+            masked |= signalOnEdge
 
             # Convert assembled to unassembled
-            wholeMask = np.ones_like(self.assem)
-            wholeMask[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth] = myMask
-            pixInd = self.assem[np.where(wholeMask==0)]
-            pixInd = pixInd[np.nonzero(pixInd)]-1
-            calibMask=np.ones((self.calibSize,))
-            calibMask[pixInd.astype(int)] = 0
-            calibMask=calibMask.reshape(self.calibShape)
+            calibMask = np.ones((self.calibSize,))
+            calibMask[self.cropInd[masked & self.hasPixel]] = 0
+            calibMask = calibMask.reshape(self.calibShape)
 
+            self.lastMask = calibMask
             return calibMask
         else:
             return None
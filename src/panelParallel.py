@@ -0,0 +1,52 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+def splitPanels(numPanels, numGroups):
+    """Contiguous (start, stop) panel ranges of nearly equal size"""
+    numGroups = max(1, min(numGroups, numPanels))
+    edges = np.linspace(0, numPanels, numGroups + 1).astype(int)
+    return [(edges[i], edges[i + 1]) for i in range(numGroups)]
+
+class PanelGroupFinder(object):
+    """Runs one peak finder per group of panels in a pool of threads.
+
+       makeAlg(mask) returns a PyAlgos like object for the panels of mask.
+       Every group has its own finder and its own slice of the mask, the
+       peak lists are merged with the segment column moved back to the
+       index of the panel in the whole stack. The speedup depends on the
+       finder releasing the GIL while it runs. The peak_finder_* methods of
+       PyAlgos are available with the same arguments.
+    """
+    def __init__(self, makeAlg, mask, numThreads):
+        self.groups = splitPanels(mask.shape[0], numThreads)
+        self.algs = [makeAlg(mask[start:stop]) for start, stop in self.groups]
+        self.pool = ThreadPool(len(self.groups))
+
+    def set_peak_selection_pars(self, **kwargs):
+        for alg in self.algs:
+            alg.set_peak_selection_pars(**kwargs)
+
+    def set_mask(self, mask):
+        for alg, (start, stop) in zip(self.algs, self.groups):
+            alg.set_mask(mask[start:stop])
+
+    def __getattr__(self, name):
+        if not name.startswith('peak_finder'):
+            raise AttributeError(name)
+        return lambda calib, **kwargs: self.findPeaks(name, calib, **kwargs)
+
+    def findPeaks(self, method, calib, **kwargs):
+        """Calls method of every group finder on its panels of calib and merges the peaks"""
+        def run(i):
+            start, stop = self.groups[i]
+            return getattr(self.algs[i], method)(calib[start:stop], **kwargs)
+        results = self.pool.map(run, range(len(self.groups)))
+        peaks = []
+        for (start, stop), result in zip(self.groups, results):
+            if result is None or len(result) == 0: continue
+            result = np.array(result)
+            result[:, 0] += start
+            peaks.append(result)
+        if not peaks:
+            return np.zeros((0, 17))
+        return np.concatenate(peaks)
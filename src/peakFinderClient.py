@@ -1,8 +1,14 @@
 import psana
 import numpy as np
-from mpidata import mpidata 
+from mpidata import mpidata, Coalescer, coalesceBufferSize
 import PeakFinder as pf
+import peakRecord
 import psanaWhisperer
+from cxiWriter import compressFrame
+from peakFinderShard import ShardWriter
+from PowderAccumulator import reduceAccumulators, addToMessage
+from eventDispenser import requestEvents
+import eventVeto
 import time
 
 from mpi4py import MPI
@@ -10,18 +16,111 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-def runclient(args):
-    ds = psana.DataSource("exp="+args.exp+":run="+str(args.run)+':idx')
-    run = ds.runs().next()
-    env = ds.env()
-    times = run.times()
-    d = psana.Detector(args.det)
-    d.do_reshape_2d_to_3d(flag=True)
-
-    ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib)
+# epics variables saved for every event: (attribute of small, pv, scale)
+epicsPVs = [('pulseLength', 'SIOC:SYS0:ML00:AO820', 1),
+            ('ebeamCharge', 'BEND:DMP1:400:BDES', 1),
+            ('beamRepRate', 'EVNT:SYS0:1:LCLSBEAMRATE', 1),
+            ('particleN_electrons', 'BPMS:DMP1:199:TMIT1H', 1),
+            ('eVernier', 'SIOC:SYS0:ML00:AO289', 1),
+            ('charge', 'BEAM:LCLS:ELEC:Q', 1),
+            ('peakCurrentAfterSecondBunchCompressor', 'SIOC:SYS0:ML00:AO195', 1),
+            ('ebeamEnergyLossConvertedToPhoton_mJ', 'SIOC:SYS0:ML00:AO569', 1),
+            ('calculatedNumberOfPhotons', 'SIOC:SYS0:ML00:AO580', 1e12), # number of photons
+            ('photonBeamEnergy', 'SIOC:SYS0:ML00:AO541', 1),
+            ('wavelength', 'SIOC:SYS0:ML00:AO192', 1)]
+
+def sendWorkRequest(batchSize, batchTime, coalescer=None, shard=None):
+    md = mpidata()
+    md.small.workRequest = True
+    md.small.batchSize = batchSize
+    md.small.batchTime = batchTime
+    if shard is not None: # report progress since results are not sent
+        md.small.numProcessed = len(shard.events)
+        md.small.numHits = len(shard.hits)
+    md.send(coalescer)
+
+def makeVeto(d, evt, args):
+    """Lit pixel veto on the raw frame, bad pixels of the status mask are ignored"""
+    pedestal = d.pedestals(evt)
+    if pedestal is None:
+        pedestal = np.zeros_like(d.raw(evt), dtype=np.float32)
+    return eventVeto.LitPixelVeto(pedestal, args.vetoThreshold, args.vetoMinLit, step=args.vetoStep,
+                                  mask=d.mask(evt, status=True), auditFraction=args.vetoAudit, seed=rank)
+
+def getVetoedResult(nevent, args):
+    """Result of an event skipped by the veto: no peaks"""
+    md = mpidata()
+    md.addarray('peaks', peakRecord.encode(np.zeros(0, dtype=peakRecord.peakDtype)))
+    md.addarray('peakRadius', np.zeros(0, dtype=np.float32))
+    md.small.eventNum = nevent
+    md.small.maxRes = 0
+    md.small.powder = 0
+    md.small.veto = eventVeto.VETOED
+    if args.profile:
+        md.small.calibTime = 0
+        md.small.peakTime = 0
+        md.small.totalTime = 0
+        md.small.rankID = rank
+    return md
+
+def makePeakFinder(args, env, evt, d, context=None, **kwargs):
+    """PeakFinder with the options of findPeaks, kwargs override them"""
+    options = dict(streakMask_on=args.streakMask_on,
+                   streakMask_sigma=args.streakMask_sigma,
+                   streakMask_width=args.streakMask_width,
+                   streakMask_tolerance=args.streakMask_tolerance,
+                   streakMask_maxAge=args.streakMask_maxAge,
+                   userMask_path=args.userMask_path,
+                   psanaMask_on=args.psanaMask_on,
+                   psanaMask_calib=args.psanaMask_calib,
+                   psanaMask_status=args.psanaMask_status,
+                   psanaMask_edges=args.psanaMask_edges,
+                   psanaMask_central=args.psanaMask_central,
+                   psanaMask_unbond=args.psanaMask_unbond,
+                   psanaMask_unbondnrs=args.psanaMask_unbondnrs,
+                   medianFilterOn=args.medianBackground,
+                   medianRank=args.medianRank,
+                   medianFast=args.medianFast,
+                   medianThreads=args.medianThreads,
+                   peakThreads=args.peakThreads,
+                   radialFilterOn=args.radialBackground,
+                   distance=args.detectorDistance,
+                   minNumPeaks=args.minPeaks,
+                   maxNumPeaks=args.maxPeaks,
+                   minResCutoff=args.minRes,
+                   clen=args.clen,
+                   localCalib=args.localCalib,
+                   context=context,
+                   powderMinPeaks=args.powderMinPeaks,
+                   powderFloat32=args.powderFloat32)
+    # parameters of the peak finding algorithm, e.g. alg1_thr_low
+    prefix = "alg%d_" % args.algorithm
+    for name, val in vars(args).items():
+        if name.startswith(prefix):
+            options[name] = val
+    options.update(kwargs)
+    return pf.PeakFinder(env.experiment(), evt.run(), args.det, evt, d,
+                         args.algorithm, args.alg_npix_min,
+                         args.alg_npix_max, args.alg_amax_thr,
+                         args.alg_atot_thr, args.alg_son_min, **options)
+
+def recvWork():
+    return comm.recv(source=0, tag=rank)
+
+def runclient(args, schema=None, context=None, workerComm=None):
+    if context is None:
+        context = psanaWhisperer.RunContext(args.exp, args.run, args.det)
+    run = context.run
+    env = context.env
+    times = context.times
+    d = context.det
+
+    ps = psanaWhisperer.psanaWhisperer(args.exp, args.run, args.det, args.clen, args.localCalib, context=context)
     ps.setupExperiment()
 
     ebeamDet = psana.Detector('EBeam')
+    epics = psanaWhisperer.EpicsCache(env.epicsStore(), args.epicsPeriod)
+    calibCycle = psanaWhisperer.CalibCycleWatcher(env)
 
     hasCoffset = False
     hasDetectorDistance = False
@@ -38,13 +137,36 @@ def runclient(args):
     elif hasDetectorDistance:
         detectorDistance = args.detectorDistance
 
-    for nevent in np.arange(len(times)):
-        if nevent == args.noe : break
-        if nevent%(size-1) != rank-1: continue # different ranks look at different events
+    # pack the results of many events into one message
+    coalescer = None
+    if args.coalesce > 0:
+        coalescer = Coalescer(args.coalesce, coalesceBufferSize(args.coalesceBufferSize, size - 1, args.coalesceMemory))
 
+    # write results to a shard file of this rank instead of sending them to the master
+    shard = None
+    if args.sharded:
+        shard = ShardWriter(args, rank, schema)
+
+    # cheap pre-stage deciding which events go through peak finding
+    veto = None
+
+    # the master hands out batches of events as ranks become free
+    for nevent in requestEvents(lambda n, t: sendWorkRequest(n, t, coalescer, shard), recvWork):
         if args.profile: startTic = time.time()
 
         evt = run.event(times[nevent])
+        vetoFlag = eventVeto.PASSED
+        if args.veto:
+            if veto is None:
+                veto = makeVeto(d, evt, args)
+            vetoFlag = veto.getFlag(d.raw(evt))
+            if vetoFlag == eventVeto.VETOED:
+                md = getVetoedResult(nevent, args)
+                if shard is not None:
+                    shard.write(md)
+                else:
+                    md.send(coalescer)
+                continue
         detarr = d.calib(evt)
 
         if args.profile: calibTime = time.time() - startTic # Time to calibrate per event
@@ -53,129 +175,49 @@ def runclient(args):
 
         # Initialize hit finding
         if not hasattr(d,'peakFinder'):
-            if args.algorithm == 1:
-                d.peakFinder = pf.PeakFinder(env.experiment(),evt.run(),args.det,evt,d,
-                                          args.algorithm, args.alg_npix_min,
-                                          args.alg_npix_max, args.alg_amax_thr,
-                                          args.alg_atot_thr, args.alg_son_min,
-                                          alg1_thr_low=args.alg1_thr_low,
-                                          alg1_thr_high=args.alg1_thr_high,
-                                          alg1_rank=args.alg1_rank,
-                                          alg1_radius=args.alg1_radius,
-                                          alg1_dr=args.alg1_dr,
-                                          streakMask_on=args.streakMask_on,
-                                          streakMask_sigma=args.streakMask_sigma,
-                                          streakMask_width=args.streakMask_width,
-                                          userMask_path=args.userMask_path,
-                                          psanaMask_on=args.psanaMask_on,
-                                          psanaMask_calib=args.psanaMask_calib,
-                                          psanaMask_status=args.psanaMask_status,
-                                          psanaMask_edges=args.psanaMask_edges,
-                                          psanaMask_central=args.psanaMask_central,
-                                          psanaMask_unbond=args.psanaMask_unbond,
-                                          psanaMask_unbondnrs=args.psanaMask_unbondnrs,
-                                          medianFilterOn=args.medianBackground,
-                                          medianRank=args.medianRank,
-                                          radialFilterOn=args.radialBackground,
-                                          distance=args.detectorDistance,
-                                          minNumPeaks=args.minPeaks,
-                                          maxNumPeaks=args.maxPeaks,
-                                          minResCutoff=args.minRes,
-                                          clen=args.clen,
-                                          localCalib=args.localCalib)
+            d.peakFinder = makePeakFinder(args, env, evt, d, context)
         if args.profile: tic = time.time()
 
         d.peakFinder.findPeaks(detarr, evt)
 
         if args.profile: peakTime = time.time() - tic # Time to find the peaks per event
         md=mpidata()
-        md.addarray('peaks', d.peakFinder.peaks)
+        md.addarray('peaks', peakRecord.encode(d.peakFinder.getPeakRecords())) # compact records, see peakRecord
+        md.addarray('peakRadius', d.peakFinder.peakRadius[:d.peakFinder.maxNumPeaks]) # pixels from the centre
         md.small.eventNum = nevent
         md.small.maxRes = d.peakFinder.maxRes
         md.small.powder = 0
+        md.small.veto = vetoFlag
         if args.profile:
             md.small.calibTime = calibTime
             md.small.peakTime = peakTime
 
-        # other cxidb data
-        ps.getEvent(nevent)
-
-        es = ps.ds.env().epicsStore()
-        try:
-            pulseLength = es.value('SIOC:SYS0:ML00:AO820') * 1e-15  # s
-        except:
-            pulseLength = 0
+        # other cxidb data, from the event fetched above
+        ps.setEvent(evt)
+        evtId = evt.get(psana.EventId)
+        md.small.sec = evtId.time()[0]
+        md.small.nsec = evtId.time()[1]
+        md.small.fid = evtId.fiducials()
 
-        md.small.pulseLength = pulseLength
+        # epics values, clen and photon energy included, are read again when a scan step begins
+        if calibCycle.changed():
+            epics.invalidate()
+        epics.update(md.small.sec, md.small.nsec)
+        for name, pv, scale in epicsPVs:
+            try:
+                setattr(md.small, name, epics.value(pv) * scale)
+            except:
+                setattr(md.small, name, 0)
 
         md.small.detectorDistance = detectorDistance
 
         md.small.pixelSize = args.pixelSize
 
         # LCLS
-        if "cxi" in args.exp:
-            md.small.lclsDet = es.value(args.clen)  # mm
-        elif "mfx" in args.exp:
-            md.small.lclsDet = es.value(args.clen)  # mm
-        elif "xpp" in args.exp:
-            md.small.lclsDet = es.value(args.clen)  # mm
-
-        try:
-            md.small.ebeamCharge = es.value('BEND:DMP1:400:BDES')
-        except:
-            md.small.ebeamCharge = 0
-
-        try:
-            md.small.beamRepRate = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-        except:
-            md.small.beamRepRate = 0
-
-        try:
-            md.small.particleN_electrons = es.value('BPMS:DMP1:199:TMIT1H')
-        except:
-            md.small.particleN_electrons = 0
-
-        try:
-            md.small.eVernier = es.value('SIOC:SYS0:ML00:AO289')
-        except:
-            md.small.eVernier = 0
-
-        try:
-            md.small.charge = es.value('BEAM:LCLS:ELEC:Q')
-        except:
-            md.small.charge = 0
-
-        try:
-            md.small.peakCurrentAfterSecondBunchCompressor = es.value('SIOC:SYS0:ML00:AO195')
-        except:
-            md.small.peakCurrentAfterSecondBunchCompressor = 0
-
-        try:
-            md.small.pulseLength = es.value('SIOC:SYS0:ML00:AO820')
-        except:
-            md.small.pulseLength = 0
-
-        try:
-            md.small.ebeamEnergyLossConvertedToPhoton_mJ = es.value('SIOC:SYS0:ML00:AO569')
-        except:
-            md.small.ebeamEnergyLossConvertedToPhoton_mJ = 0
-
-        try:
-            md.small.calculatedNumberOfPhotons = es.value('SIOC:SYS0:ML00:AO580') * 1e12  # number of photons
-        except:
-            md.small.calculatedNumberOfPhotons = 0
-
-        try:
-            md.small.photonBeamEnergy = es.value('SIOC:SYS0:ML00:AO541')
-        except:
-            md.small.photonBeamEnergy = 0
-
-        try:
-            md.small.wavelength = es.value('SIOC:SYS0:ML00:AO192')
-        except:
-            md.small.wavelength = 0
+        if "cxi" in args.exp or "mfx" in args.exp or "xpp" in args.exp:
+            md.small.lclsDet = epics.value(args.clen)  # mm
 
-        ebeam = ebeamDet.get(ps.evt)#.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
+        ebeam = ebeamDet.get(evt)#.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
         try:
             photonEnergy = ebeam.ebeamPhotonEnergy()
             pulseEnergy = ebeam.ebeamL3Energy()  # MeV
@@ -191,28 +233,49 @@ def runclient(args):
         md.small.photonEnergy = photonEnergy
         md.small.pulseEnergy = pulseEnergy
 
-        evtId = ps.evt.get(psana.EventId)
-        md.small.sec = evtId.time()[0]
-        md.small.nsec = evtId.time()[1]
-        md.small.fid = evtId.fiducials()
-
         if len(d.peakFinder.peaks) >= args.minPeaks and \
            len(d.peakFinder.peaks) <= args.maxPeaks and \
            d.peakFinder.maxRes >= args.minRes:
             # Write image in cheetah format
             img = ps.getCheetahImg()
             #assert (img is not None)
-            if img is not None: md.addarray('data', img)
+            if img is not None:
+                if args.compressFrames:
+                    # the master writes this as the hdf5 chunk of the frame
+                    md.addarray('data', compressFrame(img))
+                    md.small.compressedFrame = True
+                else:
+                    md.addarray('data', img)
 
         if args.profile:
             totalTime = time.time() - startTic
             md.small.totalTime = totalTime
             md.small.rankID = rank
-        md.send() # send mpi data object to master when desired
+        if shard is not None:
+            shard.write(md)
+        else:
+            md.send(coalescer) # send mpi data object to master when desired
+    # Tell the master which events and hits are in the shard
+    if shard is not None:
+        shard.close()
+        md = mpidata()
+        md.small.shard = shard.fname
+        md.addarray('shardEvents', np.array(shard.events, dtype=np.int64))
+        md.addarray('shardHits', np.array(shard.hits, dtype=np.int64))
+        md.send(coalescer)
     # At the end of the run, send the powder of hits and misses
+    hitPowder = missPowder = None
+    if hasattr(d, 'peakFinder'):
+        hitPowder = d.peakFinder.hitPowder
+        missPowder = d.peakFinder.missPowder
+    if workerComm is not None:
+        # merge the powders of all workers, only the first worker sends them
+        hitPowder = reduceAccumulators(workerComm, hitPowder)
+        missPowder = reduceAccumulators(workerComm, missPowder)
     md = mpidata()
-    md.small.powder = 1
-    md.addarray('powderHits', d.peakFinder.powderHits)
-    md.addarray('powderMisses', d.peakFinder.powderMisses)
-    md.send()
-    md.endrun()
+    if hitPowder is not None:
+        md.small.powder = 1
+        addToMessage(md, hitPowder, 'powderHits')
+        addToMessage(md, missPowder, 'powderMisses')
+        md.send(coalescer)
+    md.endrun(coalescer)
@@ -4,28 +4,177 @@ rank = comm.Get_rank()
 size = comm.Get_size()
 
 import h5py, json
-from mpidata import mpidata
+from mpidata import mpidata, CoalescedReceiver, coalesceBufferSize
+from eventDispenser import EventDispenser
+import peakRecord
+import eventVeto
+from PowderAccumulator import fromMessage
+from cxiWriter import EventRowBuffer, ColumnBuffer, CapacityManager, writeCompressedFrame, \
+                      contiguousRuns, replaceWithVirtual
 import psana, time
 import numpy as np
 from PSCalib.GeometryObject import two2x1ToData2x2
 
+# Datasets with one row per hit, the frames in /entry_1/data_1/data are written separately
+hitDatasets = ['/entry_1/result_1/nPeaks',
+               '/entry_1/result_1/peakXPosRaw',
+               '/entry_1/result_1/peakYPosRaw',
+               '/entry_1/result_1/peakTotalIntensity',
+               '/entry_1/result_1/maxRes',
+               '/entry_1/result_1/peakRadius',
+               '/entry_1/result_1/peakResolution',
+               '/entry_1/instrument_1/source_1/pulse_width',
+               '/LCLS/photon_energy_eV',
+               '/entry_1/instrument_1/source_1/energy',
+               '/entry_1/instrument_1/source_1/pulse_energy',
+               '/entry_1/instrument_1/detector_1/distance',
+               '/entry_1/instrument_1/detector_1/x_pixel_size',
+               '/entry_1/instrument_1/detector_1/y_pixel_size',
+               '/LCLS/detector_1/EncoderValue',
+               '/LCLS/detector_1/electronBeamEnergy',
+               '/LCLS/detector_1/beamRepRate',
+               '/LCLS/detector_1/particleN_electrons',
+               '/LCLS/eVernier',
+               '/LCLS/charge',
+               '/LCLS/peakCurrentAfterSecondBunchCompressor',
+               '/LCLS/pulseLength',
+               '/LCLS/ebeamEnergyLossConvertedToPhoton_mJ',
+               '/LCLS/calculatedNumberOfPhotons',
+               '/LCLS/photonBeamEnergy',
+               '/LCLS/wavelength',
+               '/LCLS/photon_wavelength_A',
+               '/LCLS/machineTime',
+               '/LCLS/machineTimeNanoSeconds',
+               '/LCLS/fiducial',
+               '/LCLS/eventNumber',
+               '/entry_1/experimental_identifier'] # same as /LCLS/eventNumber
+
+frameDataset = '/entry_1/instrument_1/detector_1/data'
+
+def getEventDatasets(args):
+    """Datasets with one row per event of the run"""
+    grpName = "/entry_1/result_1"
+    eventDatasets = [grpName+"/nPeaksAll", grpName+"/peakXPosRawAll", grpName+"/peakYPosRawAll",
+                     grpName+"/peakTotalIntensityAll", grpName+"/maxResAll"]
+    if args.veto:
+        eventDatasets += [grpName+"/vetoAll"]
+    if args.profile:
+        eventDatasets += [grpName+"/calibTime", grpName+"/peakTime", grpName+"/saveTime",
+                          grpName+"/totalTime", grpName+"/rankID"]
+    return eventDatasets
+
+def getPeakColumns(peaks):
+    """Returns the number of peaks, their cheetah row and col and total intensity,
+       keeping at most 2048 peak records
+    """
+    peaks = peaks[:2048] # only save upto maxNumPeaks
+    nPeaks = peaks.shape[0]
+    if nPeaks > 0:
+        cheetahRow, cheetahCol = convert_peaks_to_cheetah(peaks['seg'], peaks['row'], peaks['col'])
+        atot = peaks['atot']
+    else:
+        cheetahRow = cheetahCol = atot = np.zeros((0,))
+    return nPeaks, cheetahRow, cheetahCol, atot
+
+def getResolutionColumns(radius, small):
+    """Returns the radius in pixels and the resolution in Angstrom of the peaks of a hit"""
+    radius = radius[:2048]
+    resolution = peakRecord.radiusToResolution(radius, small.pixelSize, small.detectorDistance,
+                                               small.wavelength * 10.) # nm to A
+    return radius, resolution
+
+def getHitRow(small, args):
+    """Returns the per hit metadata of an event keyed by dataset name"""
+    return {'/entry_1/instrument_1/source_1/pulse_width': small.pulseLength,
+            '/LCLS/photon_energy_eV': small.photonEnergy,
+            '/entry_1/instrument_1/source_1/energy': small.photonEnergy * 1.60218e-19, # J
+            '/entry_1/instrument_1/source_1/pulse_energy': small.pulseEnergy,
+            '/entry_1/instrument_1/detector_1/distance': small.detectorDistance,
+            '/entry_1/instrument_1/detector_1/x_pixel_size': args.pixelSize,
+            '/entry_1/instrument_1/detector_1/y_pixel_size': args.pixelSize,
+            '/LCLS/detector_1/EncoderValue': small.lclsDet,
+            '/LCLS/detector_1/electronBeamEnergy': small.ebeamCharge,
+            '/LCLS/detector_1/beamRepRate': small.beamRepRate,
+            '/LCLS/detector_1/particleN_electrons': small.particleN_electrons,
+            '/LCLS/eVernier': small.eVernier,
+            '/LCLS/charge': small.charge,
+            '/LCLS/peakCurrentAfterSecondBunchCompressor': small.peakCurrentAfterSecondBunchCompressor,
+            '/LCLS/pulseLength': small.pulseLength,
+            '/LCLS/ebeamEnergyLossConvertedToPhoton_mJ': small.ebeamEnergyLossConvertedToPhoton_mJ,
+            '/LCLS/calculatedNumberOfPhotons': small.calculatedNumberOfPhotons,
+            '/LCLS/photonBeamEnergy': small.photonBeamEnergy,
+            '/LCLS/wavelength': small.wavelength,
+            '/LCLS/photon_wavelength_A': small.wavelength * 10.,
+            '/LCLS/machineTime': small.sec,
+            '/LCLS/machineTimeNanoSeconds': small.nsec,
+            '/LCLS/fiducial': small.fid,
+            '/LCLS/eventNumber': small.eventNum,
+            '/entry_1/experimental_identifier': small.eventNum} # same as /LCLS/eventNumber
+
+def stitchShards(h5file, shards, eventDatasets, numEvents):
+    """Replace the event and hit datasets of the cxi file by virtual datasets over the
+       shard files written by the workers, shards is a list of
+       (shard file name, event numbers of its event rows, event numbers of its hit rows).
+       Hits are ordered by event number. Returns the number of hits.
+    """
+    # unprocessed events read as -1 like in the file made by findPeaks
+    fillValues = {'/entry_1/result_1/nPeaksAll': -1, '/entry_1/result_1/maxResAll': -1,
+                  '/entry_1/result_1/vetoAll': -1}
+    sources = [(fname, len(events), contiguousRuns(events, np.arange(len(events))))
+               for fname, events, hits in shards]
+    for name in eventDatasets:
+        replaceWithVirtual(h5file, name, numEvents, sources, fillValues.get(name, 0))
+
+    hitEvents = np.concatenate([hits for fname, events, hits in shards] + [np.zeros(0, dtype=np.int64)])
+    numHits = hitEvents.size
+    position = np.empty(numHits, dtype=np.int64) # row of each shard hit in the cxi file
+    position[np.argsort(hitEvents, kind='mergesort')] = np.arange(numHits)
+    sources = []
+    offset = 0
+    for fname, events, hits in shards:
+        n = len(hits)
+        sources.append((fname, n, contiguousRuns(position[offset:offset+n], np.arange(n))))
+        offset += n
+    for name in hitDatasets + [frameDataset]:
+        replaceWithVirtual(h5file, name, numHits, sources)
+    return numHits
+
+def saveVetoSummary(h5file, args):
+    """Store the veto rate and the estimated fraction of the hits that were vetoed
+       as attributes of /entry_1/result_1/vetoAll, see eventVeto.summarize
+    """
+    grpName = "/entry_1/result_1"
+    veto = h5file[grpName+"/vetoAll"][()]
+    nPeaks = h5file[grpName+"/nPeaksAll"][()]
+    maxRes = h5file[grpName+"/maxResAll"][()]
+    isHit = (nPeaks >= args.minPeaks) & (nPeaks <= args.maxPeaks) & (maxRes >= args.minRes)
+    summary = eventVeto.summarize(veto, isHit, args.vetoAudit)
+    for key, val in summary.items():
+        h5file[grpName+"/vetoAll"].attrs[key] = val
+    return summary
+
 def writeStatus(fname,d):
     json.dump(d, open(fname, 'w'))
 
 def convert_peaks_to_cheetah(s, r, c) :
     """Converts seg, row, col assuming (32,185,388)
        to cheetah 2-d table row and col (8*185, 4*388)
+       Works on scalars as well as on arrays of peaks.
     """
     segs, rows, cols = (32,185,388)
-    row2d = (int(s)%8) * rows + int(r) # where s%8 is a segment in quad number [0,7]
-    col2d = (int(s)/8) * cols + int(c) # where s/8 is a quad number [0,3]
+    s = np.asarray(s).astype(int)
+    row2d = (s%8) * rows + np.asarray(r).astype(int) # where s%8 is a segment in quad number [0,7]
+    col2d = (s//8) * cols + np.asarray(c).astype(int) # where s/8 is a quad number [0,3]
     return row2d, col2d
 
-def getNoe(args):
-    runStr = "%04d" % args.run
-    ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
-    run = ds.runs().next()
-    times = run.times()
+def getNoe(args, context=None):
+    if context is not None:
+        times = context.times
+    else:
+        runStr = "%04d" % args.run
+        ds = psana.DataSource("exp="+args.exp+":run="+runStr+':idx')
+        run = ds.runs().next()
+        times = run.times()
     # check if the user requested specific number of events
     if args.noe == -1:
         numJobs = len(times)
@@ -48,7 +197,7 @@ def updateHdf5(h5file, dataset, ind, val):
     except:
         h5file[dataset][ind] = 0
 
-def runmaster(args, nClients):
+def runmaster(args, nClients, context=None):
 
     runStr = "%04d" % args.run
     fname = args.outDir +"/"+ args.exp +"_"+ runStr + ".cxi"
@@ -65,18 +214,15 @@ def runmaster(args, nClients):
     dset_rankID = "/rankID"
     statusFname = args.outDir + "/status_peaks.txt"
 
-    powderHits = None
-    powderMisses = None
+    hitPowder = None
+    missPowder = None
 
-    maxSize = 0
     numInc = 0
-    inc = 100
-    dataShape = (0,0)
     numProcessed = 0
     numHits = 0
     hitRate = 0.0
     fracDone = 0.0
-    numEvents = getNoe(args)
+    numEvents = getNoe(args, context)
     d = {"numHits": numHits, "hitRate": hitRate, "fracDone": fracDone}
     try:
         writeStatus(statusFname, d)
@@ -84,23 +230,62 @@ def runmaster(args, nClients):
         print "Couldn't update status"
         pass
 
+    dispenser = EventDispenser(numEvents, nClients, targetTime=args.batchTime, maxBatch=args.maxBatchSize)
+
     myHdf5 = h5py.File(fname, 'r+')
+    # per event results are buffered and written in blocks of consecutive events
+    eventDatasets = getEventDatasets(args)
+    eventBuffer = EventRowBuffer(myHdf5, eventDatasets, maxRows=args.writeBufferSize, flushInterval=args.flushInterval)
+    # per hit metadata is appended to a columnar buffer and written in blocks
+    hitBuffer = ColumnBuffer(myHdf5, hitDatasets, maxRows=args.writeBufferSize, flushInterval=args.flushInterval)
+    # all hit datasets, including the frames, grow together and are trimmed once at the end
+    hitCapacity = CapacityManager(myHdf5, hitDatasets + [frameDataset],
+                                  maxCapacity=numEvents)
+    # shard files written by the workers when args.sharded
+    shards = []
+    progress = {}
+
+    # coalesced messages arrive in receive buffers posted ahead of time
+    receiver = None
+    if args.coalesce > 0:
+        receiver = CoalescedReceiver(range(1, size), coalesceBufferSize(args.coalesceBufferSize, size - 1, args.coalesceMemory))
     while nClients > 0:
         # Remove client if the run ended
-        md = mpidata()
-        md.recv()
+        if receiver is not None:
+            md = receiver.recv() # arrays are only valid until the next recv
+        else:
+            md = mpidata()
+            md.recv()
         if md.small.endrun:
             nClients -= 1
+        elif md.small.workRequest:
+            batch = dispenser.nextBatch(md.small.batchSize, md.small.batchTime)
+            comm.send(batch, dest=md.source, tag=md.source)
+            if args.sharded:
+                # workers write their own results, they only report progress
+                progress[md.source] = (md.small.numProcessed, md.small.numHits)
+                numProcessed = sum([p[0] for p in progress.values()])
+                numHits = sum([p[1] for p in progress.values()])
+                try:
+                    hitRate = numHits * 100. / max(numProcessed, 1)
+                    fracDone = numProcessed * 100. / numEvents
+                    d = {"numHits": numHits, "hitRate": hitRate, "fracDone": fracDone}
+                    writeStatus(statusFname, d)
+                except:
+                    print "Couldn't update status"
+                    pass
+        elif hasattr(md.small, 'shard'):
+            shards.append((md.small.shard, md.shardEvents.copy(), md.shardHits.copy()))
         elif md.small.powder == 1:
-            if powderHits is None:
-                powderHits = md.powderHits
-                powderMisses = md.powderMisses
+            if hitPowder is None:
+                hitPowder = fromMessage(md, 'powderHits')
+                missPowder = fromMessage(md, 'powderMisses')
             else:
-                powderHits = np.maximum(powderHits, md.powderHits)
-                powderMisses = np.maximum(powderMisses, md.powderMisses)
+                hitPowder.merge(fromMessage(md, 'powderHits'))
+                missPowder.merge(fromMessage(md, 'powderMisses'))
         else:
             try:
-                nPeaks = md.peaks.shape[0]
+                peaks = peakRecord.decode(md.peaks)
                 maxRes = md.small.maxRes
                 if args.profile:
                     calibTime = md.small.calibTime
@@ -112,115 +297,60 @@ def runmaster(args, nClients):
                 maxRes = 0
                 continue
 
-            if nPeaks > 2048: # only save upto maxNumPeaks
-                md.peaks = md.peaks[:2048]
-                nPeaks = md.peaks.shape[0]
-
             if args.profile: tic = time.time()
 
-            for i,peak in enumerate(md.peaks):
-                seg,row,col,npix,amax,atot,rcent,ccent,rsigma,csigma,rmin,rmax,cmin,cmax,bkgd,rms,son = peak[0:17]
-                cheetahRow,cheetahCol = convert_peaks_to_cheetah(seg,row,col)
-                myHdf5[grpName+dset_posX][md.small.eventNum,i] = cheetahCol
-                myHdf5[grpName+dset_posY][md.small.eventNum,i] = cheetahRow
-                myHdf5[grpName+dset_atot][md.small.eventNum,i] = atot
-                myHdf5.flush()
-            myHdf5[grpName+dset_nPeaks][md.small.eventNum] = nPeaks
-            myHdf5[grpName+dset_maxRes][md.small.eventNum] = maxRes
-            myHdf5.flush()
+            nPeaks, cheetahRow, cheetahCol, atot = getPeakColumns(peaks)
+            row = {grpName+dset_nPeaks: nPeaks,
+                   grpName+dset_posX: cheetahCol,
+                   grpName+dset_posY: cheetahRow,
+                   grpName+dset_atot: atot,
+                   grpName+dset_maxRes: maxRes}
+            if args.veto:
+                row[grpName+"/vetoAll"] = md.small.veto
 
             if args.profile:
                 saveTime = time.time() - tic # Time to save the peaks found per event
-                myHdf5[grpName + dset_calibTime][md.small.eventNum] = calibTime
-                myHdf5[grpName + dset_peakTime][md.small.eventNum] = peakTime
-                myHdf5[grpName + dset_saveTime][md.small.eventNum] = saveTime
-                myHdf5[grpName + dset_totalTime][md.small.eventNum] = totalTime
-                myHdf5[grpName + dset_rankID][md.small.eventNum] = rankID
-                myHdf5.flush()
+                row[grpName + dset_calibTime] = calibTime
+                row[grpName + dset_peakTime] = peakTime
+                row[grpName + dset_saveTime] = saveTime
+                row[grpName + dset_totalTime] = totalTime
+                row[grpName + dset_rankID] = rankID
+            eventBuffer.append(md.small.eventNum, row)
 
             # If the event is a hit
             if nPeaks >= args.minPeaks and \
                nPeaks <= args.maxPeaks and \
                maxRes >= args.minRes and \
                hasattr(md, 'data'):
-                # Assign a bigger array
-                if maxSize == numHits:
-                    if args.profile: tic = time.time()
-                    reshapeHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, inc)
-                    myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHits + inc, 2048))
-                    myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHits + inc, 2048))
-                    myHdf5["/entry_1/result_1/peakTotalIntensity"].resize((numHits + inc, 2048))
-                    reshapeHdf5(myHdf5, '/entry_1/result_1/maxRes', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_width', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/photon_energy_eV', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/source_1/energy', numHits, inc) # J
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_energy', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/detector_1/distance', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/detector_1/x_pixel_size', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/instrument_1/detector_1/y_pixel_size', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/detector_1/EncoderValue', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/detector_1/electronBeamEnergy', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/detector_1/beamRepRate', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/detector_1/particleN_electrons', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/eVernier', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/charge', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/peakCurrentAfterSecondBunchCompressor', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/pulseLength', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/ebeamEnergyLossConvertedToPhoton_mJ', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/calculatedNumberOfPhotons', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/photonBeamEnergy', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/wavelength', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/photon_wavelength_A', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/machineTime', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/machineTimeNanoSeconds', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/fiducial', numHits, inc)
-                    reshapeHdf5(myHdf5, '/LCLS/eventNumber', numHits, inc)
-                    reshapeHdf5(myHdf5, '/entry_1/experimental_identifier', numHits, inc) # same as /LCLS/eventNumber
-                    dataShape = md.data.shape
-                    myHdf5["/entry_1/data_1/data"].resize((numHits + inc, md.data.shape[0], md.data.shape[1]))
+                # Assign a bigger array, sized from the hit rate seen so far
+                if args.profile: tic = time.time()
+                projected = 0
+                if numProcessed >= 1000: # hit rate is too noisy before that
+                    projected = 1.1 * (numHits + 1) * numEvents / float(numProcessed)
+                if hitCapacity.reserve(numHits + 1, projected):
                     if args.profile:
                         reshapeHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, 1)
                         reshapeTime = time.time() - tic
                         updateHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc, reshapeTime)
-                    maxSize += inc
                     numInc += 1
 
-                # Save peak information
-                updateHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits, nPeaks)
-                myHdf5["/entry_1/result_1/peakXPosRaw"][numHits,:] = myHdf5[grpName+dset_posX][md.small.eventNum,:]
-                myHdf5["/entry_1/result_1/peakYPosRaw"][numHits,:] = myHdf5[grpName+dset_posY][md.small.eventNum,:]
-                myHdf5["/entry_1/result_1/peakTotalIntensity"][numHits,:] = myHdf5[grpName+dset_atot][md.small.eventNum,:]
-                updateHdf5(myHdf5, '/entry_1/result_1/maxRes', numHits, maxRes)
-                # Save epics
-                updateHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_width', numHits, md.small.pulseLength)
-                updateHdf5(myHdf5, '/LCLS/photon_energy_eV', numHits, md.small.photonEnergy)
-                updateHdf5(myHdf5, '/entry_1/instrument_1/source_1/energy', numHits, md.small.photonEnergy * 1.60218e-19) # J
-                updateHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_energy', numHits, md.small.pulseEnergy)
-                updateHdf5(myHdf5, '/entry_1/instrument_1/detector_1/distance', numHits, md.small.detectorDistance)
-                updateHdf5(myHdf5, '/entry_1/instrument_1/detector_1/x_pixel_size', numHits, args.pixelSize)
-                updateHdf5(myHdf5, '/entry_1/instrument_1/detector_1/y_pixel_size', numHits, args.pixelSize)
-                updateHdf5(myHdf5, '/LCLS/detector_1/EncoderValue', numHits, md.small.lclsDet)
-                updateHdf5(myHdf5, '/LCLS/detector_1/electronBeamEnergy', numHits, md.small.ebeamCharge)
-                updateHdf5(myHdf5, '/LCLS/detector_1/beamRepRate', numHits, md.small.beamRepRate)
-                updateHdf5(myHdf5, '/LCLS/detector_1/particleN_electrons', numHits, md.small.particleN_electrons)
-                updateHdf5(myHdf5, '/LCLS/eVernier', numHits, md.small.eVernier)
-                updateHdf5(myHdf5, '/LCLS/charge', numHits, md.small.charge)
-                updateHdf5(myHdf5, '/LCLS/peakCurrentAfterSecondBunchCompressor', numHits, md.small.peakCurrentAfterSecondBunchCompressor)
-                updateHdf5(myHdf5, '/LCLS/pulseLength', numHits, md.small.pulseLength)
-                updateHdf5(myHdf5, '/LCLS/ebeamEnergyLossConvertedToPhoton_mJ', numHits, md.small.ebeamEnergyLossConvertedToPhoton_mJ)
-                updateHdf5(myHdf5, '/LCLS/calculatedNumberOfPhotons', numHits, md.small.calculatedNumberOfPhotons)
-                updateHdf5(myHdf5, '/LCLS/photonBeamEnergy', numHits, md.small.photonBeamEnergy)
-                updateHdf5(myHdf5, '/LCLS/wavelength', numHits, md.small.wavelength)
-                updateHdf5(myHdf5, '/LCLS/photon_wavelength_A', numHits, md.small.wavelength * 10.)
-                updateHdf5(myHdf5, '/LCLS/machineTime', numHits, md.small.sec)
-                updateHdf5(myHdf5, '/LCLS/machineTimeNanoSeconds', numHits, md.small.nsec)
-                updateHdf5(myHdf5, '/LCLS/fiducial', numHits, md.small.fid)
-                updateHdf5(myHdf5, '/LCLS/eventNumber', numHits, md.small.eventNum)
-                updateHdf5(myHdf5, '/entry_1/experimental_identifier', numHits, md.small.eventNum) # same as /LCLS/eventNumber
+                # Save peak information and epics
+                row = getHitRow(md.small, args)
+                row['/entry_1/result_1/nPeaks'] = nPeaks
+                row['/entry_1/result_1/peakXPosRaw'] = cheetahCol
+                row['/entry_1/result_1/peakYPosRaw'] = cheetahRow
+                row['/entry_1/result_1/peakTotalIntensity'] = atot
+                row['/entry_1/result_1/maxRes'] = maxRes
+                radius, resolution = getResolutionColumns(getattr(md, 'peakRadius', np.zeros((0,))), md.small)
+                row['/entry_1/result_1/peakRadius'] = radius
+                row['/entry_1/result_1/peakResolution'] = resolution
+                hitBuffer.append(row)
                 # Save images
-                myHdf5["/entry_1/data_1/data"][numHits, :, :] = md.data
+                if getattr(md.small, 'compressedFrame', False):
+                    writeCompressedFrame(myHdf5["/entry_1/data_1/data"], numHits, md.data)
+                else:
+                    myHdf5["/entry_1/data_1/data"][numHits, :, :] = md.data
                 numHits += 1
-                myHdf5.flush()
             numProcessed += 1
             # Update status
             if numProcessed % 120:
@@ -233,73 +363,25 @@ def runmaster(args, nClients):
                     print "Couldn't update status"
                     pass
 
-    # Crop back to the correct size
-    cropHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits)
-    myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHits, 2048))
-    myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHits, 2048))
-    myHdf5["/entry_1/result_1/peakTotalIntensity"].resize((numHits, 2048))
-    cropHdf5(myHdf5, '/entry_1/result_1/maxRes', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_width', numHits)
-    cropHdf5(myHdf5, '/LCLS/photon_energy_eV', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/source_1/energy', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/source_1/pulse_energy', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/detector_1/distance', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/detector_1/x_pixel_size', numHits)
-    cropHdf5(myHdf5, '/entry_1/instrument_1/detector_1/y_pixel_size', numHits)
-    cropHdf5(myHdf5, '/LCLS/detector_1/EncoderValue', numHits)
-    cropHdf5(myHdf5, '/LCLS/detector_1/electronBeamEnergy', numHits)
-    cropHdf5(myHdf5, '/LCLS/detector_1/beamRepRate', numHits)
-    cropHdf5(myHdf5, '/LCLS/detector_1/particleN_electrons', numHits)
-    cropHdf5(myHdf5, '/LCLS/eVernier', numHits)
-    cropHdf5(myHdf5, '/LCLS/charge', numHits)
-    cropHdf5(myHdf5, '/LCLS/peakCurrentAfterSecondBunchCompressor', numHits)
-    cropHdf5(myHdf5, '/LCLS/pulseLength', numHits)
-    cropHdf5(myHdf5, '/LCLS/ebeamEnergyLossConvertedToPhoton_mJ', numHits)
-    cropHdf5(myHdf5, '/LCLS/calculatedNumberOfPhotons', numHits)
-    cropHdf5(myHdf5, '/LCLS/photonBeamEnergy', numHits)
-    cropHdf5(myHdf5, '/LCLS/wavelength', numHits)
-    cropHdf5(myHdf5, '/LCLS/photon_wavelength_A', numHits)
-    cropHdf5(myHdf5, '/LCLS/machineTime', numHits)
-    cropHdf5(myHdf5, '/LCLS/machineTimeNanoSeconds', numHits)
-    cropHdf5(myHdf5, '/LCLS/fiducial', numHits)
-    cropHdf5(myHdf5, '/LCLS/eventNumber', numHits)
-    cropHdf5(myHdf5, '/entry_1/experimental_identifier', numHits)  # same as /LCLS/eventNumber
-    myHdf5["/entry_1/data_1/data"].resize((numHits, dataShape[0], dataShape[1]))
+    if args.sharded:
+        # the cxi file only maps onto the shards, in event order
+        numHits = stitchShards(myHdf5, sorted(shards), eventDatasets, numEvents)
+    else:
+        eventBuffer.flush()
+        hitBuffer.flush()
+
+        # Crop back to the correct size
+        hitCapacity.trim(numHits)
     if args.profile:
         cropHdf5(myHdf5, '/entry_1/result_1/reshapeTime', numInc)
+    if args.veto:
+        summary = saveVetoSummary(myHdf5, args)
+        print "Veto rate %.3f, false negative rate %.3f from %d audited events" % \
+              (summary['vetoRate'], summary['falseNegativeRate'], summary['numAudited'])
 
     # Save attributes
-    myHdf5["LCLS/detector_1/EncoderValue"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/detector_1/electronBeamEnergy"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/detector_1/beamRepRate"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/detector_1/particleN_electrons"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/eVernier"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/charge"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/peakCurrentAfterSecondBunchCompressor"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/pulseLength"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/ebeamEnergyLossConvertedToPhoton_mJ"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/calculatedNumberOfPhotons"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/photonBeamEnergy"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/wavelength"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/machineTime"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/machineTimeNanoSeconds"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/fiducial"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/photon_energy_eV"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/photon_wavelength_A"].attrs["numEvents"] = numHits
-    myHdf5["LCLS/eventNumber"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/experimental_identifier"].attrs["numEvents"] = numHits
-    myHdf5["/entry_1/result_1/nPeaks"].attrs["numEvents"] = numHits
-    myHdf5["/entry_1/result_1/peakXPosRaw"].attrs["numEvents"] = numHits
-    myHdf5["/entry_1/result_1/peakYPosRaw"].attrs["numEvents"] = numHits
-    myHdf5["/entry_1/result_1/peakTotalIntensity"].attrs["numEvents"] = numHits
-    myHdf5["/entry_1/result_1/maxRes"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/source_1/energy"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/source_1/pulse_energy"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/source_1/pulse_width"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/detector_1/data"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/detector_1/distance"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/detector_1/x_pixel_size"].attrs["numEvents"] = numHits
-    myHdf5["entry_1/instrument_1/detector_1/y_pixel_size"].attrs["numEvents"] = numHits
+    for name in hitCapacity.datasets:
+        myHdf5[name].attrs["numEvents"] = numHits
 
     if '/status/findPeaks' in myHdf5:
         del myHdf5['/status/findPeaks']
@@ -316,6 +398,11 @@ def runmaster(args, nClients):
         pass
 
     # Save powder patterns
+    powderHits = hitPowder.max
+    powderMisses = missPowder.max
+    for name, acc in [("Hits", hitPowder), ("Misses", missPowder)]:
+        np.save(args.outDir +"/"+ args.exp +"_"+ runStr + "_mean" + name + ".npy", acc.mean())
+        np.save(args.outDir +"/"+ args.exp +"_"+ runStr + "_sigma" + name + ".npy", acc.sigma())
     fnameHits = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.npy"
     fnameMisses = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxMisses.npy"
     fnameHitsTxt = args.outDir +"/"+ args.exp +"_"+ runStr + "_maxHits.txt"
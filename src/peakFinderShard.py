@@ -0,0 +1,89 @@
+import os, time
+import h5py
+import numpy as np
+import peakRecord
+from cxiWriter import ColumnBuffer, CapacityManager, createDatasets, writeCompressedFrame
+from peakFinderMaster import hitDatasets, frameDataset, getEventDatasets, getPeakColumns, getHitRow, \
+                             getResolutionColumns
+
+def getShardName(args, rank):
+    """File name of the shard of a rank, relative to the output directory"""
+    return args.exp + "_" + "%04d" % args.run + "_shard%04d.h5" % rank
+
+class ShardWriter(object):
+    """Writes the results of the events processed by one worker to its own shard file.
+
+       The shard holds the same datasets as the cxi file made by findPeaks, with
+       rows in the order the worker processed its events. The master stitches the
+       shards together with virtual datasets at the end of the run.
+    """
+    def __init__(self, args, rank, schema):
+        self.args = args
+        self.rank = rank
+        self.fname = getShardName(args, rank)
+        self.h5file = h5py.File(os.path.join(args.outDir, self.fname), 'w')
+        createDatasets(self.h5file, schema)
+        self.eventDatasets = getEventDatasets(args)
+        self.eventBuffer = ColumnBuffer(self.h5file, self.eventDatasets, maxRows=args.writeBufferSize,
+                                        flushInterval=args.flushInterval)
+        self.eventCapacity = CapacityManager(self.h5file, self.eventDatasets)
+        self.hitBuffer = ColumnBuffer(self.h5file, hitDatasets, maxRows=args.writeBufferSize,
+                                      flushInterval=args.flushInterval)
+        self.hitCapacity = CapacityManager(self.h5file, hitDatasets + [frameDataset])
+        self.events = [] # event number of every row of the event datasets
+        self.hits = [] # event number of every row of the hit datasets
+
+    def write(self, md):
+        """Write the mpidata of an event, as it would have been sent to the master"""
+        args = self.args
+        small = md.small
+        arrays = dict(zip([arrinfo.name for arrinfo in small.arrayinfolist], md.arraylist))
+        grpName = "/entry_1/result_1"
+
+        if args.profile: tic = time.time()
+        nPeaks, cheetahRow, cheetahCol, atot = getPeakColumns(peakRecord.decode(arrays['peaks']))
+        row = {grpName+"/nPeaksAll": nPeaks,
+               grpName+"/peakXPosRawAll": cheetahCol,
+               grpName+"/peakYPosRawAll": cheetahRow,
+               grpName+"/peakTotalIntensityAll": atot,
+               grpName+"/maxResAll": small.maxRes}
+        if args.veto:
+            row[grpName+"/vetoAll"] = small.veto
+        if args.profile:
+            row[grpName+"/calibTime"] = small.calibTime
+            row[grpName+"/peakTime"] = small.peakTime
+            row[grpName+"/saveTime"] = time.time() - tic
+            row[grpName+"/totalTime"] = small.totalTime
+            row[grpName+"/rankID"] = self.rank
+        self.eventCapacity.reserve(len(self.events) + 1)
+        self.eventBuffer.append(row)
+        self.events.append(small.eventNum)
+
+        # the client only attaches a frame to hits
+        if 'data' in arrays:
+            numHits = len(self.hits)
+            self.hitCapacity.reserve(numHits + 1)
+            row = getHitRow(small, args)
+            row[grpName+'/nPeaks'] = nPeaks
+            row[grpName+'/peakXPosRaw'] = cheetahCol
+            row[grpName+'/peakYPosRaw'] = cheetahRow
+            row[grpName+'/peakTotalIntensity'] = atot
+            row[grpName+'/maxRes'] = small.maxRes
+            radius, resolution = getResolutionColumns(arrays.get('peakRadius', np.zeros((0,))), small)
+            row[grpName+'/peakRadius'] = radius
+            row[grpName+'/peakResolution'] = resolution
+            self.hitBuffer.append(row)
+            if getattr(small, 'compressedFrame', False):
+                writeCompressedFrame(self.h5file[frameDataset], numHits, arrays['data'])
+            else:
+                self.h5file[frameDataset][numHits, :, :] = arrays['data']
+            self.hits.append(small.eventNum)
+
+    def close(self):
+        self.eventBuffer.flush()
+        self.hitBuffer.flush()
+        self.eventCapacity.trim(len(self.events))
+        self.hitCapacity.trim(len(self.hits))
+        for name in self.hitCapacity.datasets:
+            self.h5file[name].attrs["numEvents"] = len(self.hits)
+        self.h5file.close()
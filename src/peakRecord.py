@@ -0,0 +1,43 @@
+import numpy as np
+
+# Compact record of a peak found by PyAlgos, shared by PeakFinder, the clients and the master.
+# PyAlgos returns a float64 array with one row per peak and the columns
+# seg,row,col,npix,amax,atot,rcent,ccent,rsigma,csigma,rmin,rmax,cmin,cmax,bkgd,rms,son
+# The integer valued columns are stored as int16 and the others as float32,
+# which takes 52 instead of 136 bytes per peak.
+columns = ['seg', 'row', 'col', 'npix', 'amax', 'atot', 'rcent', 'ccent', 'rsigma', 'csigma',
+           'rmin', 'rmax', 'cmin', 'cmax', 'bkgd', 'rms', 'son']
+intColumns = ['seg', 'row', 'col', 'npix', 'rmin', 'rmax', 'cmin', 'cmax']
+floatColumns = [name for name in columns if name not in intColumns]
+
+peakDtype = np.dtype([(name, np.int16) for name in intColumns] +
+                     [(name, np.float32) for name in floatColumns])
+
+def pack(peaks):
+    """Convert a PyAlgos peak array to an array of records"""
+    peaks = np.asarray(peaks)
+    records = np.zeros(peaks.shape[0], dtype=peakDtype)
+    if peaks.shape[0] > 0:
+        for i, name in enumerate(columns):
+            records[name] = peaks[:, i]
+    return records
+
+def encode(records):
+    """Records, e.g. made by pack, as bytes ready to be sent"""
+    return np.asarray(records, dtype=peakDtype).view(np.uint8)
+
+def decode(buf):
+    """Records from the bytes made by encode, without a copy"""
+    return np.asarray(buf).view(peakDtype)
+
+def radiusToResolution(radius, pixelSize, distance, wavelength):
+    """Resolution in Angstrom of a radius in pixels from the beam centre,
+       with pixelSize and distance in m and wavelength in Angstrom.
+       Returns 0 where the resolution is undefined.
+    """
+    radius = np.asarray(radius, dtype=np.float64)
+    resolution = np.zeros(radius.shape)
+    if pixelSize > 0 and distance > 0 and wavelength > 0:
+        sinTheta = np.sin(0.5 * np.arctan(radius * pixelSize / distance))
+        np.divide(wavelength, 2 * sinTheta, out=resolution, where=sinTheta > 0)
+    return resolution
@@ -6,24 +6,132 @@ from PSCalib.GeometryAccess import GeometryAccess
 from pyimgalgos.RadialBkgd import RadialBkgd, polarization_factor
 import Detector.PyDetector
 
+class EpicsCache(object):
+    """Serves values of an epicsStore without looking every PV up for every event.
+
+       Values are read once and served until invalidate(), which is called when
+       a calib cycle begins. With a period > 0 they are also read again once
+       period seconds of machine time separate the current event from the last
+       read, in either direction. PVs missing from the store are not looked up
+       again until the next refresh.
+    """
+    def __init__(self, epicsStore, period=0.):
+        self.epicsStore = epicsStore
+        self.period = period
+        self.values = {}
+        self.missing = set()
+        self.lastRead = None
+
+    def invalidate(self):
+        self.values = {}
+        self.missing = set()
+        self.lastRead = None
+
+    def update(self, sec, nsec=0):
+        """Set the machine time of the current event"""
+        if self.period <= 0: return
+        t = sec + nsec * 1e-9
+        if self.lastRead is None or abs(t - self.lastRead) >= self.period:
+            self.values = {}
+            self.missing = set()
+            self.lastRead = t
+
+    def value(self, pv, default=None):
+        if pv in self.missing: return default
+        if pv not in self.values:
+            try:
+                val = self.epicsStore.value(pv)
+            except:
+                val = None
+            if val is None:
+                self.missing.add(pv)
+                return default
+            self.values[pv] = val
+        return self.values[pv]
+
+class CalibCycleWatcher(object):
+    """Tells when a new calib cycle begins from the scanned variables of the ControlData
+       config. The config type of the run is looked up once, runs without one never
+       change calib cycle.
+    """
+    def __init__(self, env):
+        self.configStore = env.configStore()
+        self.configType = None
+        for config in ['ConfigV3', 'ConfigV2', 'ConfigV1']:
+            try:
+                if self.configStore.get(getattr(psana.ControlData, config), psana.Source()) is not None:
+                    self.configType = getattr(psana.ControlData, config)
+                    break
+            except:
+                continue
+        self.current = None
+
+    def changed(self):
+        """True for the first event and whenever the scanned values differ from the last call"""
+        if self.configType is None:
+            if self.current is None:
+                self.current = ()
+                return True
+            return False
+        control = self.configStore.get(self.configType, psana.Source())
+        step = tuple((pv.name(), pv.value()) for pv in control.pvControls()) if control is not None else ()
+        if step != self.current:
+            self.current = step
+            return True
+        return False
+
+class RunContext(object):
+    """DataSource, run and detector of a run, opened once per rank and shared
+       by every component that needs them. Geometry and the first event are
+       only fetched when asked for.
+    """
+    def __init__(self, experimentName, runNumber, detInfo):
+        self.experimentName = experimentName
+        self.runNumber = runNumber
+        self.detInfo = detInfo
+        self.ds = psana.DataSource('exp=' + str(experimentName) + ':run=' + str(runNumber) + ':idx')
+        self.run = self.ds.runs().next()
+        self.times = self.run.times()
+        self.eventTotal = len(self.times)
+        self.env = self.ds.env()
+        self.det = psana.Detector(str(detInfo), self.env)
+        self.det.do_reshape_2d_to_3d(flag=True)
+        self.firstEvent = None
+        self.geometry = None
+
+    def getEvent(self, number):
+        return self.run.event(self.times[number])
+
+    def getFirstEvent(self):
+        if self.firstEvent is None:
+            self.firstEvent = self.getEvent(0)
+        return self.firstEvent
+
+    def getGeometry(self):
+        if self.geometry is None:
+            self.geometry = self.det.geometry(self.run)
+        return self.geometry
+
 class psanaWhisperer():
-    def __init__(self, experimentName, runNumber, detInfo, clen='', aduPerPhoton=1, localCalib=False):
+    def __init__(self, experimentName, runNumber, detInfo, clen='', aduPerPhoton=1, localCalib=False, context=None):
         self.experimentName = experimentName
         self.runNumber = runNumber
         self.detInfo = detInfo
         self.clenStr = clen
         self.aduPerPhoton = aduPerPhoton
         self.localCalib = localCalib
+        self.context = context
 
     def setupExperiment(self):
-        self.ds = psana.DataSource('exp=' + str(self.experimentName) + ':run=' + str(self.runNumber) + ':idx')
-        self.run = self.ds.runs().next()
-        self.times = self.run.times()
-        self.eventTotal = len(self.times)
-        self.env = self.ds.env()
-        self.evt = self.run.event(self.times[0])
-        self.det = psana.Detector(str(self.detInfo), self.env)
-        self.det.do_reshape_2d_to_3d(flag=True)
+        if self.context is None:
+            self.context = RunContext(self.experimentName, self.runNumber, self.detInfo)
+        self.ds = self.context.ds
+        self.run = self.context.run
+        self.times = self.context.times
+        self.eventTotal = self.context.eventTotal
+        self.env = self.context.env
+        self.evt = self.context.getFirstEvent()
+        self.det = self.context.det
         self.getDetInfoList()
         self.detAlias = self.getDetectorAlias(str(self.detInfo))
         self.updateClen() # Get epics variable, clen
@@ -59,6 +167,10 @@ class psanaWhisperer():
     def getEvent(self, number):
         self.evt = self.run.event(self.times[number])
 
+    def setEvent(self, evt):
+        """Use an event that was already fetched instead of fetching it again"""
+        self.evt = evt
+
     def getImg(self, number):
         self.getEvent(number)
         img = self.det.image(self.evt, self.det.calib(self.evt))
@@ -0,0 +1,166 @@
+# Sweep peak finder parameters in a single pass over a run.
+# Every event is calibrated, masked and background subtracted once, then searched
+# with each configuration of a json file, e.g.
+# {"configs": [{"name": "default"},
+#              {"name": "lowThreshold", "alg1_thr_high": 200, "alg_amax_thr": 150},
+#              {"name": "strict", "alg_son_min": 15, "minPeaks": 20},
+#              {"name": "v3", "algorithm": 3, "alg3_rank": 4}]}
+# Configurations override findPeaks options by name. Algorithms 1, 3 and 4 can be
+# swept, each with its algN_ parameters. The hit rate and peak
+# statistics of each configuration are written to <outDir>/<exp>_<run>_sweep.json
+import argparse, copy, json, time
+import numpy as np
+import psanaWhisperer
+from peakFinderClient import makePeakFinder
+from mpi4py import MPI
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-e','--exp', help="experiment name (e.g. cxic0415)", type=str)
+parser.add_argument('-r','--run', help="run number (e.g. 24)", type=int)
+parser.add_argument('-d','--det', help="detector name (e.g. pnccdFront)", type=str)
+parser.add_argument('-o','--outDir', help="output directory where the summary will be saved", type=str)
+parser.add_argument('-c','--config', help="json file with the peak finder configurations", type=str)
+parser.add_argument("-n","--noe",help="number of events to process",default=-1, type=int)
+parser.add_argument("--algorithm",help="peak finding algorithm",default=1, type=int)
+parser.add_argument("--alg_npix_min",help="minimum number of pixels of a peak",default=1., type=float)
+parser.add_argument("--alg_npix_max",help="maximum number of pixels of a peak",default=45., type=float)
+parser.add_argument("--alg_amax_thr",help="minimum maximum intensity of a peak",default=250., type=float)
+parser.add_argument("--alg_atot_thr",help="minimum total intensity of a peak",default=330., type=float)
+parser.add_argument("--alg_son_min",help="minimum signal over noise of a peak",default=10., type=float)
+parser.add_argument("--alg1_thr_low",help="low threshold",default=80., type=float)
+parser.add_argument("--alg1_thr_high",help="high threshold",default=270., type=float)
+parser.add_argument("--alg1_rank",help="rank",default=3, type=int)
+parser.add_argument("--alg1_radius",help="radius",default=3, type=int)
+parser.add_argument("--alg1_dr",help="ring width",default=1., type=float)
+parser.add_argument("--alg3_rank",help="rank of algorithm 3",default=3, type=int)
+parser.add_argument("--alg3_r0",help="radius of algorithm 3",default=5., type=float)
+parser.add_argument("--alg3_dr",help="ring width of algorithm 3",default=0.05, type=float)
+parser.add_argument("--alg4_thr_low",help="low threshold of algorithm 4",default=10., type=float)
+parser.add_argument("--alg4_thr_high",help="high threshold of algorithm 4",default=150., type=float)
+parser.add_argument("--alg4_rank",help="rank of algorithm 4",default=3, type=int)
+parser.add_argument("--alg4_r0",help="radius of algorithm 4",default=5, type=int)
+parser.add_argument("--alg4_dr",help="ring width of algorithm 4",default=0.05, type=float)
+parser.add_argument("--streakMask_on",help="streak mask on",default="False", type=str)
+parser.add_argument("--streakMask_sigma",help="streak mask sigma above background",default=0., type=float)
+parser.add_argument("--streakMask_width",help="streak mask width",default=0, type=float)
+parser.add_argument("--streakMask_tolerance",help="drift of the streak region signature above which the streak mask is recomputed",default=0.05, type=float)
+parser.add_argument("--streakMask_maxAge",help="maximum number of events a streak mask is reused for, 1 recomputes it for every event",default=1, type=int)
+parser.add_argument("--userMask_path",help="full path to user mask numpy array",default=None, type=str)
+parser.add_argument("--psanaMask_on",help="psana mask on",default="False", type=str)
+parser.add_argument("--psanaMask_calib",help="psana calib on",default="False", type=str)
+parser.add_argument("--psanaMask_status",help="psana status on",default="False", type=str)
+parser.add_argument("--psanaMask_edges",help="psana edges on",default="False", type=str)
+parser.add_argument("--psanaMask_central",help="psana central on",default="False", type=str)
+parser.add_argument("--psanaMask_unbond",help="psana unbonded pixels on",default="False", type=str)
+parser.add_argument("--psanaMask_unbondnrs",help="psana unbonded pixel neighbors on",default="False", type=str)
+parser.add_argument("--medianBackground",help="subtract median background",default=0, type=int)
+parser.add_argument("--medianRank",help="median background window size",default=0, type=int)
+parser.add_argument("--medianFast",help="approximate separable median background, see medianBackground",default=0, type=int)
+parser.add_argument("--medianThreads",help="number of threads filtering detector panels with --medianFast",default=1, type=int)
+parser.add_argument("--peakThreads",help="number of threads searching groups of detector panels for peaks",default=1, type=int)
+parser.add_argument("--radialBackground",help="subtract radial background",default=0, type=int)
+parser.add_argument("--clen", help="camera length epics name (e.g. CXI:DS1:MMS:06.RBV or CXI:DS2:MMS:06.RBV)", type=str)
+parser.add_argument("--detectorDistance", help="detector distance from interaction point (m)", default=0, type=float)
+parser.add_argument("--minPeaks", help="Index only if above minimum number of peaks",default=15, type=int)
+parser.add_argument("--maxPeaks", help="Index only if below maximum number of peaks",default=2048, type=int)
+parser.add_argument("--minRes", help="Index only if above minimum resolution",default=0, type=int)
+parser.add_argument("--localCalib", help="Use local calib directory. A calib directory must exist in your current working directory.", action='store_true')
+args = parser.parse_args()
+args.powderMinPeaks = -1 # no powders are made in a sweep
+args.powderFloat32 = False
+
+# Options of the preprocessing done once per event, shared by all configurations
+sharedOptions = ['det', 'userMask_path', 'medianBackground', 'medianRank', 'medianFast', 'medianThreads',
+                 'radialBackground', 'detectorDistance', 'clen', 'localCalib']
+sharedPrefixes = ['streakMask_', 'psanaMask_']
+
+# Bins of the histogram of the number of peaks per event
+peakBins = [0, 1, 5, 10, 15, 20, 30, 50, 100, 200, 500, 1000, 2049]
+
+def getConfigArgs(args, config):
+    """Copy of args with the options of a configuration"""
+    cfgArgs = copy.copy(args)
+    for key, val in config.items():
+        if key == 'name': continue
+        if not hasattr(args, key):
+            raise ValueError("Unknown option %s in configuration %s" % (key, config.get('name')))
+        if key in sharedOptions or any([key.startswith(p) for p in sharedPrefixes]):
+            raise ValueError("Option %s is shared by all configurations, set it on the command line" % key)
+        setattr(cfgArgs, key, val)
+    for key in config:
+        if key[:3] == 'alg' and key[3:4].isdigit() and not key.startswith("alg%d_" % cfgArgs.algorithm):
+            raise ValueError("Option %s is not used by algorithm %d in configuration %s" % (key, cfgArgs.algorithm, config.get('name')))
+    return cfgArgs
+
+def summarize(config, cfgArgs, nPeaks, maxRes):
+    """Hit rate and peak statistics of a configuration, unprocessed events have nPeaks -1"""
+    processed = nPeaks >= 0
+    isHit = processed & (nPeaks >= cfgArgs.minPeaks) & (nPeaks <= cfgArgs.maxPeaks) & (maxRes >= cfgArgs.minRes)
+    numProcessed = int(processed.sum())
+    numHits = int(isHit.sum())
+    summary = {'name': config.get('name'),
+               'options': dict([(k, v) for k, v in config.items() if k != 'name']),
+               'numProcessed': numProcessed,
+               'numHits': numHits,
+               'hitRate': numHits * 100. / max(numProcessed, 1),
+               'meanPeaks': float(nPeaks[processed].mean()) if numProcessed else 0.,
+               'meanPeaksOfHits': float(nPeaks[isHit].mean()) if numHits else 0.,
+               'meanMaxResOfHits': float(maxRes[isHit].mean()) if numHits else 0.,
+               'peakBins': peakBins,
+               'peakHistogram': np.histogram(nPeaks[processed], bins=peakBins)[0].tolist()}
+    return summary
+
+configs = json.load(open(args.config))['configs']
+configArgs = [getConfigArgs(args, config) for config in configs]
+
+context = psanaWhisperer.RunContext(args.exp, args.run, args.det)
+run = context.run
+times = context.times
+env = context.env
+d = context.det
+numEvents = len(times) if args.noe == -1 else min(args.noe, len(times))
+
+# every rank processes a contiguous share of the events
+myEvents = np.array_split(np.arange(numEvents), size)[rank]
+nPeaks = -np.ones((len(configs), numEvents), dtype=np.int32)
+maxRes = -np.ones((len(configs), numEvents), dtype=np.float32)
+
+base = None
+tic = time.time()
+for nevent in myEvents:
+    evt = run.event(times[nevent])
+    calib = d.calib(evt)
+    if calib is None: continue
+    if base is None:
+        # base does the preprocessing, the configurations only search for peaks
+        base = makePeakFinder(args, env, evt, d, context, powder=False)
+        finders = [makePeakFinder(cfgArgs, env, evt, d, context, powder=False, streakMask_on="False",
+                                  medianFilterOn=0, radialFilterOn=0) for cfgArgs in configArgs]
+    calib = base.preprocess(calib, evt)
+    for i, finder in enumerate(finders):
+        finder.setStreakMask(base.streakMask)
+        finder.peakFind(calib)
+        nPeaks[i, nevent] = finder.numPeaksFound
+        maxRes[i, nevent] = finder.maxRes
+print "Rank %d processed %d events with %d configurations in %.1f s" % (rank, len(myEvents), len(configs), time.time() - tic)
+
+# unprocessed entries are -1 on every other rank
+allPeaks = np.zeros_like(nPeaks)
+allMaxRes = np.zeros_like(maxRes)
+comm.Reduce(nPeaks, allPeaks, op=MPI.MAX, root=0)
+comm.Reduce(maxRes, allMaxRes, op=MPI.MAX, root=0)
+
+if rank == 0:
+    summaries = [summarize(config, cfgArgs, allPeaks[i], allMaxRes[i])
+                 for i, (config, cfgArgs) in enumerate(zip(configs, configArgs))]
+    fname = args.outDir + "/" + args.exp + "_" + "%04d" % args.run + "_sweep.json"
+    json.dump({'exp': args.exp, 'run': args.run, 'numEvents': numEvents, 'configs': summaries},
+              open(fname, 'w'), indent=1)
+    for s in summaries:
+        print "%20s: hit rate %6.2f%%, %d hits, %.1f peaks per event" % (s['name'], s['hitRate'], s['numHits'], s['meanPeaks'])
+
+MPI.Finalize()
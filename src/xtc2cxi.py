@@ -7,6 +7,7 @@ import argparse
 import os, json
 
 import psanaWhisperer
+from cxiWriter import ColumnBuffer
 
 from mpi4py import MPI
 import Detector.PyDetector
@@ -461,9 +462,32 @@ if rank == 0:
     except:
         pass
 
+# Per hit values are collected in columns and written in blocks
+metaDatasets = [ds_expId, ds_pulseWidth, ds_dist_1, ds_x_pixel_size_1, ds_y_pixel_size_1, ds_lclsDet_1,
+                ds_ebeamCharge_1, ds_beamRepRate_1, ds_particleN_electrons_1, ds_eVernier_1, ds_charge_1,
+                ds_peakCurrentAfterSecondBunchCompressor_1, ds_pulseLength_1, ds_ebeamEnergyLossConvertedToPhoton_mJ_1,
+                ds_calculatedNumberOfPhotons_1, ds_photonBeamEnergy_1, ds_wavelength_1, ds_wavelengthA_1,
+                ds_photonEnergy, ds_photonEnergy_1, ds_pulseEnergy, ds_sec_1, ds_nsec_1, ds_fid_1, ds_evtNum_1]
+if mode == 'sfx':
+    metaDatasets += [ds_nPeaks, ds_posX, ds_posY, ds_atot, ds_maxRes]
+elif mode == 'spi':
+    metaDatasets += [ds_nHits]
+if myJobs is not None and len(myJobs) > 0:
+    firstInd = myJobs[0]
+else:
+    firstInd = 0
+# h5 flush is collective with the mpio driver, so the buffer only writes
+hitBuffer = ColumnBuffer(f, [ds.name for ds in metaDatasets], start=firstInd, flushInterval=None, flushFile=False)
+
+def epicsValue(es, pvName):
+    try:
+        return es.value(pvName)
+    except:
+        return 0
+
 for i,val in enumerate(myHitInd):
     globalInd = myJobs[0]+i
-    ds_expId[globalInd] = val
+    row = {ds_expId.name: val}
     ps.getEvent(val)
     ebeamDet = psana.Detector('EBeam')
     # Write image in cheetah format
@@ -497,120 +521,71 @@ for i,val in enumerate(myHitInd):
         pulseLength = 0
         numPhotons = 0
 
-    ds_pulseWidth[globalInd] = pulseLength
-    ds_dist_1[globalInd] = detectorDistance
-    ds_x_pixel_size_1[globalInd] = x_pixel_size
-    ds_y_pixel_size_1[globalInd] = y_pixel_size
-    f.flush()
+    row[ds_pulseWidth.name] = pulseLength
+    row[ds_dist_1.name] = detectorDistance
+    row[ds_x_pixel_size_1.name] = x_pixel_size
+    row[ds_y_pixel_size_1.name] = y_pixel_size
 
     # LCLS
     if "cxi" in args.exp:
-        ds_lclsDet_1[globalInd] = es.value(args.clen) # mm
+        row[ds_lclsDet_1.name] = es.value(args.clen) # mm
     elif "mfx" in args.exp:
-        ds_lclsDet_1[globalInd] = 0 # FIXME
+        row[ds_lclsDet_1.name] = 0 # FIXME
     elif "xpp" in args.exp:
-        ds_lclsDet_1[globalInd] = es.value(args.clen)  # mm
-
-    try:
-        ds_ebeamCharge_1[globalInd] = es.value('BEND:DMP1:400:BDES')
-    except:
-        ds_ebeamCharge_1[globalInd] = 0
-
-    try:
-        ds_beamRepRate_1[globalInd] = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-    except:
-        ds_beamRepRate_1[globalInd] = 0
-
-    try:
-        ds_particleN_electrons_1[globalInd] = es.value('BPMS:DMP1:199:TMIT1H')
-    except:
-        ds_particleN_electrons_1[globalInd] = 0
-
-    try:
-        ds_eVernier_1[globalInd] = es.value('SIOC:SYS0:ML00:AO289')
-    except:
-        ds_eVernier_1[globalInd] = 0
-
-    try:
-        ds_charge_1[globalInd] = es.value('BEAM:LCLS:ELEC:Q')
-    except:
-        ds_charge_1[globalInd] = 0
-
-    try:
-        ds_peakCurrentAfterSecondBunchCompressor_1[globalInd] = es.value('SIOC:SYS0:ML00:AO195')
-    except:
-        ds_peakCurrentAfterSecondBunchCompressor_1[globalInd] = 0
-
-    try:
-        ds_pulseLength_1[globalInd] = es.value('SIOC:SYS0:ML00:AO820')
-    except:
-        ds_pulseLength_1[globalInd] = 0
-
-    try:
-        ds_ebeamEnergyLossConvertedToPhoton_mJ_1[globalInd] = es.value('SIOC:SYS0:ML00:AO569')
-    except:
-        ds_ebeamEnergyLossConvertedToPhoton_mJ_1[globalInd] = 0
-
+        row[ds_lclsDet_1.name] = es.value(args.clen)  # mm
+
+    row[ds_ebeamCharge_1.name] = epicsValue(es, 'BEND:DMP1:400:BDES')
+    row[ds_beamRepRate_1.name] = epicsValue(es, 'EVNT:SYS0:1:LCLSBEAMRATE')
+    row[ds_particleN_electrons_1.name] = epicsValue(es, 'BPMS:DMP1:199:TMIT1H')
+    row[ds_eVernier_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO289')
+    row[ds_charge_1.name] = epicsValue(es, 'BEAM:LCLS:ELEC:Q')
+    row[ds_peakCurrentAfterSecondBunchCompressor_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO195')
+    row[ds_pulseLength_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO820')
+    row[ds_ebeamEnergyLossConvertedToPhoton_mJ_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO569')
+    row[ds_calculatedNumberOfPhotons_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO580')
+    row[ds_photonBeamEnergy_1.name] = epicsValue(es, 'SIOC:SYS0:ML00:AO541')
+    wavelength = epicsValue(es, 'SIOC:SYS0:ML00:AO192')
+    row[ds_wavelength_1.name] = wavelength
     try:
-        ds_calculatedNumberOfPhotons_1[globalInd] = es.value('SIOC:SYS0:ML00:AO580')
+        wavelengthA = wavelength * 10.
     except:
-        ds_calculatedNumberOfPhotons_1[globalInd] = 0
-
-    try:
-        ds_photonBeamEnergy_1[globalInd] = es.value('SIOC:SYS0:ML00:AO541')
-    except:
-        ds_photonBeamEnergy_1[globalInd] = 0
-
-    try:
-        ds_wavelength_1[globalInd] = es.value('SIOC:SYS0:ML00:AO192')
-    except:
-        ds_wavelength_1[globalInd] = 0
-
-    try:
-        ds_wavelengthA_1[globalInd] = ds_wavelength_1[globalInd] * 10.
-    except:
-        ds_wavelengthA_1[globalInd] = 0
+        wavelengthA = 0
+    row[ds_wavelengthA_1.name] = wavelengthA
 
     ebeam = ebeamDet.get(ps.evt)  #ebeam = ps.evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
     try:
-        ds_photonEnergy[globalInd] = ebeam.ebeamPhotonEnergy()
+        row[ds_photonEnergy.name] = ebeam.ebeamPhotonEnergy()
     except:
-        ds_photonEnergy[globalInd] = 0
+        row[ds_photonEnergy.name] = 0
     try:
         photonEnergy = ebeam.ebeamPhotonEnergy() * 1.60218e-19 # J
         pulseEnergy = ebeam.ebeamL3Energy() # MeV
     except:
         photonEnergy = 0
         pulseEnergy = 0
-        if ds_wavelengthA_1[globalInd] > 0:
+        if wavelengthA > 0:
             h = 6.626070e-34  # J.m
             c = 2.99792458e8  # m/s
             joulesPerEv = 1.602176621e-19  # J/eV
-            photonEnergy = (h / joulesPerEv * c) / (ds_wavelengthA_1[globalInd] * 1e-9)
-    ds_photonEnergy_1[globalInd] = photonEnergy
-    ds_pulseEnergy[globalInd] = pulseEnergy
-
-    f.flush()
+            photonEnergy = (h / joulesPerEv * c) / (wavelengthA * 1e-9)
+    row[ds_photonEnergy_1.name] = photonEnergy
+    row[ds_pulseEnergy.name] = pulseEnergy
 
     evtId = ps.evt.get(psana.EventId)
-    sec = evtId.time()[0]
-    nsec = evtId.time()[1]
-    fid = evtId.fiducials()
-
-    ds_sec_1[globalInd] = sec
-    ds_nsec_1[globalInd] = nsec
-    ds_fid_1[globalInd] = fid
-    ds_evtNum_1[globalInd] = val
+    row[ds_sec_1.name] = evtId.time()[0]
+    row[ds_nsec_1.name] = evtId.time()[1]
+    row[ds_fid_1.name] = evtId.fiducials()
+    row[ds_evtNum_1.name] = val
 
     if mode == 'sfx':
-        ds_nPeaks[globalInd] = nPeaks[val]
-        ds_posX[globalInd,:] = posX[val,:]
-        ds_posY[globalInd,:] = posY[val,:]
-        ds_atot[globalInd,:] = atot[val,:]
-        ds_maxRes[globalInd] = maxRes[val]
+        row[ds_nPeaks.name] = nPeaks[val]
+        row[ds_posX.name] = posX[val,:]
+        row[ds_posY.name] = posY[val,:]
+        row[ds_atot.name] = atot[val,:]
+        row[ds_maxRes.name] = maxRes[val]
     elif mode == 'spi':
-        ds_nHits[globalInd] = nHits[val]
-    f.flush()
+        row[ds_nHits.name] = nHits[val]
+    hitBuffer.append(row)
 
     if i%100 == 0: print "Rank: "+str(rank)+", Done "+str(i)+" out of "+str(len(myJobs))
 
@@ -623,6 +598,7 @@ for i,val in enumerate(myHitInd):
         except:
             pass
 
+hitBuffer.flush()
 f.close()
 
 if rank == 0: